@@ -0,0 +1,277 @@
+import argparse
+import collections
+import email.parser
+import http.server
+import itertools
+import json
+import queue
+import socket
+import statistics
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+# Local stand-in for the Telegram Bot API to measure update throughput of the bot.
+# Point the bot to it with telegram_api_base_url = "http://127.0.0.1:8081/bot" in secrets.py.
+# In polling mode synthetic updates are served through getUpdates, in webhook mode they are
+# posted to the bot's webhook. Replies of the bot are matched to the updates per chat.
+
+BOT_USER = {
+    "id": 1,
+    "is_bot": True,
+    "first_name": "Fake medialib bot",
+    "username": "fake_medialib_bot",
+    "can_join_groups": True,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": True,
+}
+REPLY_METHODS = {"sendMessage", "sendPhoto", "sendDocument", "sendMediaGroup", "sendAnimation"}
+
+
+def make_update(update_id, chat_id, text):
+    user = {"id": chat_id, "is_bot": False, "first_name": "User {}".format(chat_id), "username": "user{}".format(chat_id)}
+    entities = []
+    if text.startswith("/"):
+        entities.append({"type": "bot_command", "offset": 0, "length": len(text.split(" ", 1)[0])})
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "username": user["username"], "first_name": user["first_name"]},
+            "from": user,
+            "text": text,
+            "entities": entities,
+        }
+    }
+
+
+def make_inline_query_update(update_id, user_id, query, offset=""):
+    user = {"id": user_id, "is_bot": False, "first_name": "User {}".format(user_id), "username": "user{}".format(user_id)}
+    return {
+        "update_id": update_id,
+        "inline_query": {
+            "id": str(update_id),
+            "from": user,
+            "query": query,
+            "offset": offset,
+            "chat_type": "sender",
+        }
+    }
+
+
+def make_reply(method, parameters, message_id):
+    # Result of a send* method: the sent message with fake file_ids for uploads.
+    message = {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": int(parameters.get("chat_id", 0)), "type": "private"},
+        "from": BOT_USER,
+    }
+    if method == "sendMessage":
+        message["text"] = parameters.get("text", "")
+    elif method == "sendPhoto":
+        file_id = "fake-photo-{}".format(message_id)
+        message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 1024, "height": 1024}]
+    elif method in {"sendDocument", "sendAnimation"}:
+        file_id = "fake-document-{}".format(message_id)
+        message["document"] = {"file_id": file_id, "file_unique_id": file_id}
+    if method == "sendMediaGroup":
+        # one message per album item
+        media = parameters.get("media", [])
+        if isinstance(media, str):
+            media = json.loads(media)
+        messages = []
+        for i in range(max(len(media), 1)):
+            file_id = "fake-photo-{}-{}".format(message_id, i)
+            messages.append(dict(
+                message,
+                message_id=message_id * 100 + i,
+                photo=[{"file_id": file_id, "file_unique_id": file_id, "width": 1024, "height": 1024}]
+            ))
+        return messages
+    return message
+
+
+def parse_parameters(content_type, body):
+    if content_type.startswith("application/json"):
+        return json.loads(body or b"{}")
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        return dict(urllib.parse.parse_qsl(body.decode()))
+    if content_type.startswith("multipart/form-data"):
+        message = email.parser.BytesParser().parsebytes(
+            b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body
+        )
+        parameters = {}
+        for part in message.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename() is None:
+                parameters[name] = part.get_payload(decode=True).decode()
+        return parameters
+    return {}
+
+
+class FakeTelegramAPI:
+    def __init__(self, updates, chats, text):
+        self.pending_updates = queue.Queue()
+        self.lock = threading.Lock()
+        self.sent_at = collections.defaultdict(collections.deque)
+        self.latencies = []
+        self.first_sent = None
+        self.last_reply = None
+        self.expected_replies = updates
+        self.done = threading.Event()
+        self.message_ids = itertools.count(1)
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.webhook_set = threading.Event()
+        for update_id in range(1, updates + 1):
+            self.pending_updates.put(make_update(update_id, 1000 + update_id % chats, text))
+
+    def mark_sent(self, update):
+        with self.lock:
+            now = time.perf_counter()
+            if self.first_sent is None:
+                self.first_sent = now
+            self.sent_at[update["message"]["chat"]["id"]].append(now)
+
+    def mark_reply(self, chat_id):
+        with self.lock:
+            now = time.perf_counter()
+            sent = self.sent_at.get(chat_id)
+            if sent:
+                self.latencies.append(now - sent.popleft())
+            self.last_reply = now
+            if len(self.latencies) >= self.expected_replies:
+                self.done.set()
+
+    def get_updates(self, parameters):
+        limit = int(parameters.get("limit", 100))
+        timeout = float(parameters.get("timeout", 0))
+        result = []
+        deadline = time.monotonic() + min(timeout, 1)
+        while len(result) < limit:
+            try:
+                wait = max(deadline - time.monotonic(), 0) if len(result) == 0 else 0
+                update = self.pending_updates.get(timeout=wait) if wait else self.pending_updates.get_nowait()
+            except queue.Empty:
+                break
+            self.mark_sent(update)
+            result.append(update)
+        return result
+
+    def reply(self, method, parameters):
+        result = make_reply(method, parameters, next(self.message_ids))
+        self.mark_reply(int(parameters.get("chat_id", 0)))
+        return result
+
+    def call(self, method, parameters):
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            return self.get_updates(parameters)
+        if method == "setWebhook":
+            self.webhook_url = parameters.get("url")
+            self.webhook_secret = parameters.get("secret_token")
+            self.webhook_set.set()
+            return True
+        if method in REPLY_METHODS:
+            return self.reply(method, parameters)
+        return True
+
+
+def make_handler(api: FakeTelegramAPI):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            method = self.path.rsplit("/", 1)[-1]
+            parameters = parse_parameters(self.headers.get("Content-Type", ""), body)
+            response = json.dumps({"ok": True, "result": api.call(method, parameters)}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        do_GET = do_POST
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def post_updates(api: FakeTelegramAPI, webhook_url):
+    while True:
+        try:
+            update = api.pending_updates.get_nowait()
+        except queue.Empty:
+            return
+        request = urllib.request.Request(
+            webhook_url, data=json.dumps(update).encode(), headers={"Content-Type": "application/json"}
+        )
+        if api.webhook_secret:
+            request.add_header("X-Telegram-Bot-Api-Secret-Token", api.webhook_secret)
+        api.mark_sent(update)
+        with urllib.request.urlopen(request) as response:
+            response.read()
+
+
+def wait_for_listener(url, timeout=10):
+    # the bot registers the webhook before its server starts listening
+    parsed = urllib.parse.urlsplit(url)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((parsed.hostname, parsed.port or 443), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API for load testing the bot.")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--mode", choices=["polling", "webhook"], default="polling")
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--text", default="load test", help="message text, e.g. /start to call a command")
+    parser.add_argument("--concurrency", type=int, default=16, help="parallel webhook requests")
+    parser.add_argument("--webhook-url", help="defaults to the url the bot registers with setWebhook")
+    args = parser.parse_args()
+
+    api = FakeTelegramAPI(args.updates, args.chats, args.text)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(api))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("fake Bot API listens on http://127.0.0.1:{}/bot, {} mode".format(args.port, args.mode))
+
+    if args.mode == "webhook":
+        webhook_url = args.webhook_url
+        if webhook_url is None:
+            api.webhook_set.wait()
+            webhook_url = api.webhook_url
+        wait_for_listener(webhook_url)
+        print("posting {} updates to {}".format(args.updates, webhook_url))
+        for i in range(args.concurrency):
+            threading.Thread(target=post_updates, args=(api, webhook_url), daemon=True).start()
+
+    api.done.wait()
+    server.shutdown()
+    latencies = sorted(api.latencies)
+    elapsed = api.last_reply - api.first_sent
+    print("{} updates answered in {:.2f} s: {:.1f} updates/s".format(len(latencies), elapsed, len(latencies) / elapsed))
+    print("latency p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms, mean {:.1f} ms".format(
+        latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.9)] * 1000,
+        latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        statistics.fmean(latencies) * 1000
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import os
+import pathlib
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+import fake_telegram_api
+import synthetic_medialib
+
+# Drives the real handlers of main.py with synthetic updates. medialib_db is replaced by
+# synthetic_medialib over a generated library, Bot API calls are answered in process by
+# StubRequest, everything else (pool, caches, transcoder, uploads) runs as in production.
+#
+#   python benchmarks/handler_benchmark.py --requests 200 --save-baseline baseline.json
+#   python benchmarks/handler_benchmark.py --requests 200 --baseline baseline.json
+#
+# With --baseline the run fails (exit code 1) when a command got slower than the tolerance.
+
+sys.modules["medialib_db"] = synthetic_medialib
+
+import bot_config
+import secrets
+
+COMMANDS = {
+    "start": "/start",
+    "safe": "/safe",
+    "suggestive": "/suggestive",
+    "nsfw": "/nsfw",
+    "explicit": "/explicit",
+    "safe_query": "/safe tag_1 not tag_2",
+    "safe_album": "/safe x5",
+    "tag": "/tag tag_1*",
+    "best": "/best {post_id}",
+    "webp": "/webp {post_id}",
+    "animation": "/animation {post_id}",
+    "inline": "safe",
+}
+# answered from the file_ids stored by the commands run before them
+INLINE_COMMANDS = {"inline"}
+# these need posts registered by the rating commands run before them
+POST_COMMANDS = {"best", "webp", "animation"}
+
+
+class StubRequest(BaseRequest):
+    # Answers Bot API calls without network after latency seconds. Uploads are still read,
+    # as they would be to be sent.
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.message_ids = itertools.count(1)
+        self.calls = collections.Counter()
+        self.uploaded_bytes = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] += 1
+        parameters = dict()
+        if request_data is not None:
+            parameters = request_data.parameters
+            if request_data.contains_files:
+                for name, (filename, content, mime_type) in request_data.multipart_data.items():
+                    if isinstance(content, bytes):
+                        self.uploaded_bytes += len(content)
+                    else:
+                        while True:
+                            chunk = content.read(1 << 16)
+                            if not chunk:
+                                break
+                            self.uploaded_bytes += len(chunk)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if endpoint == "getMe":
+            result = fake_telegram_api.BOT_USER
+        elif endpoint in fake_telegram_api.REPLY_METHODS:
+            result = fake_telegram_api.make_reply(endpoint, parameters, next(self.message_ids))
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run_command(application, command, requests, concurrency, chats, posts, update_ids):
+    # Returns the latency of every request in seconds and the wall time of the whole run.
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(chat_id, text):
+        async with semaphore:
+            if command in INLINE_COMMANDS:
+                update = fake_telegram_api.make_inline_query_update(next(update_ids), chat_id, text)
+            else:
+                update = fake_telegram_api.make_update(next(update_ids), chat_id, text)
+            update = Update.de_json(update, application.bot)
+            start = time.perf_counter()
+            await application.process_update(update)
+            latencies.append(time.perf_counter() - start)
+
+    jobs = []
+    for i in range(requests):
+        chat_id = chats[i % len(chats)]
+        text = COMMANDS[command]
+        if command in POST_COMMANDS:
+            chat_posts = posts.get(chat_id)
+            if not chat_posts:
+                continue
+            text = text.format(post_id=chat_posts[i % len(chat_posts)])
+        jobs.append(one(chat_id, text))
+    start = time.perf_counter()
+    await asyncio.gather(*jobs)
+    return sorted(latencies), time.perf_counter() - start
+
+
+async def measure_memory(application, command, requests, concurrency, chats, posts, update_ids):
+    # Separate short run under tracemalloc, which would distort the timings.
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        await run_command(application, command, requests, concurrency, chats, posts, update_ids)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return (peak - before) / 1024, (current - before) / 1024
+
+
+def compare(results, baseline, tolerance):
+    failures = []
+    for command, result in results.items():
+        reference = baseline.get(command)
+        if reference is None:
+            continue
+        if result["rps"] < reference["rps"] * (1 - tolerance):
+            failures.append("{}: {:.1f} requests/s, baseline {:.1f}".format(command, result["rps"], reference["rps"]))
+        if result["p90_ms"] > reference["p90_ms"] * (1 + tolerance):
+            failures.append("{}: p90 {:.1f} ms, baseline {:.1f} ms".format(command, result["p90_ms"], reference["p90_ms"]))
+    return failures
+
+
+async def benchmark(args, work_directory: pathlib.Path):
+    synthetic_medialib.build_dataset(args.dataset or work_directory.joinpath("library"), args.content)
+    bot_config.FILE_ID_CACHE_PATH = str(work_directory.joinpath("bot_cache.sqlite"))
+    bot_config.PREVIEW_CACHE_DIR = str(work_directory.joinpath("preview_cache"))
+    bot_config.POST_WRITE_BEHIND = False
+    bot_config.METRICS_PORT = None
+    if args.transcoder_workers is not None:
+        bot_config.TRANSCODER_WORKERS = args.transcoder_workers
+    if not hasattr(secrets, "API_key"):
+        # no secrets.py: the standard library module got imported instead
+        secrets.API_key = "123:benchmark"
+        secrets.bad_words = []
+
+    import main
+
+    request = StubRequest(args.api_latency / 1000)
+    application = main.build_application(updater=False, request=request)
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+
+    chats = [1000 + i for i in range(args.chats)]
+    update_ids = itertools.count(1)
+    results = dict()
+    try:
+        for command in args.commands:
+            if command not in COMMANDS:
+                raise SystemExit("unknown command {}, known: {}".format(command, ", ".join(COMMANDS)))
+            posts = dict()
+            if command in POST_COMMANDS:
+                connection = synthetic_medialib.make_connection()
+                posts = synthetic_medialib.posts_by_telegram_user(connection)
+                connection.close()
+            latencies, elapsed = await run_command(
+                application, command, args.requests, args.concurrency, chats, posts, update_ids
+            )
+            if len(latencies) == 0:
+                print("{}: no requests, run a rating command before it".format(command))
+                continue
+            result = {
+                "requests": len(latencies),
+                "rps": len(latencies) / elapsed,
+                "p50_ms": percentile(latencies, 0.5) * 1000,
+                "p90_ms": percentile(latencies, 0.9) * 1000,
+                "p99_ms": percentile(latencies, 0.99) * 1000,
+                "mean_ms": statistics.fmean(latencies) * 1000,
+            }
+            if args.memory_requests:
+                result["peak_kib"], result["retained_kib"] = await measure_memory(
+                    application, command, args.memory_requests, args.concurrency, chats, posts, update_ids
+                )
+            results[command] = result
+            print("{:<11} {:>6} req {:>8.1f} req/s  p50 {:>7.1f} ms  p90 {:>7.1f} ms  p99 {:>7.1f} ms{}".format(
+                command,
+                result["requests"],
+                result["rps"],
+                result["p50_ms"],
+                result["p90_ms"],
+                result["p99_ms"],
+                "  peak {:>8.0f} KiB  retained {:>7.0f} KiB".format(result["peak_kib"], result["retained_kib"])
+                if "peak_kib" in result else ""
+            ))
+    finally:
+        await application.stop()
+        await application.shutdown()
+        await application.post_shutdown(application)
+    print("Bot API calls: {}, uploaded {:.1f} MiB".format(
+        dict(request.calls), request.uploaded_bytes / (1 << 20)
+    ))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bot handlers on a synthetic library.")
+    parser.add_argument("--content", type=int, default=5000, help="library size")
+    parser.add_argument("--dataset", help="library directory, kept between runs (default: temporary)")
+    parser.add_argument("--requests", type=int, default=200, help="requests per command")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--api-latency", type=float, default=0, help="Bot API reply delay in ms")
+    parser.add_argument("--transcoder-workers", type=int)
+    parser.add_argument("--memory-requests", type=int, default=20,
+                        help="requests per command measured with tracemalloc, 0 to skip")
+    parser.add_argument("--commands", nargs="+", default=list(COMMANDS))
+    parser.add_argument("--save-baseline", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="fail when slower than the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="handler_benchmark") as work_directory:
+        results = asyncio.run(benchmark(args, pathlib.Path(work_directory)))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            failures = compare(results, json.load(f), args.tolerance)
+        for failure in failures:
+            print("REGRESSION", failure)
+        if len(failures):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+import argparse
+import asyncio
+import collections
+import functools
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from candidate_pool import CandidatePool
+
+# Synthetic stand-in for the medialib content/tag schema: every item gets one rating tag
+# and a few random other tags, hidden items are mixed in as in the real library.
+RATING_TAGS = {"safe": 1, "suggestive": 2, "explicit": 3}
+RATING_WEIGHTS = [0.6, 0.25, 0.15]
+OTHER_TAGS = range(10, 1010)
+
+MATCHING_QUERY = (
+    "FROM content JOIN content_tags_list ON content_tags_list.content_id = content.ID "
+    "WHERE content_tags_list.tag_id = ? AND content.hidden = 0"
+)
+
+
+def make_library(size: int) -> sqlite3.Connection:
+    connection = sqlite3.connect(":memory:")
+    connection.execute("CREATE TABLE content (ID INTEGER PRIMARY KEY, file_path TEXT, hidden INTEGER)")
+    connection.execute("CREATE TABLE content_tags_list (content_id INTEGER, tag_id INTEGER)")
+    rng = random.Random(637)
+    content_rows = []
+    tag_rows = []
+    for content_id in range(1, size + 1):
+        content_rows.append((content_id, "pictures/{}.webp".format(content_id), int(rng.random() < 0.02)))
+        rating = rng.choices(list(RATING_TAGS.values()), RATING_WEIGHTS)[0]
+        tag_rows.append((content_id, rating))
+        for tag_id in rng.sample(OTHER_TAGS, 3):
+            tag_rows.append((content_id, tag_id))
+    connection.executemany("INSERT INTO content VALUES (?, ?, ?)", content_rows)
+    connection.executemany("INSERT INTO content_tags_list VALUES (?, ?)", tag_rows)
+    connection.execute("CREATE INDEX content_tags_list_tag ON content_tags_list (tag_id, content_id)")
+    connection.commit()
+    return connection
+
+
+def order_by_random(connection, tag_id):
+    return connection.execute(
+        "SELECT content.ID " + MATCHING_QUERY + " ORDER BY RANDOM() LIMIT 1", (tag_id,)
+    ).fetchall()
+
+
+def random_offset(connection, tag_id):
+    count = connection.execute("SELECT COUNT(*) " + MATCHING_QUERY, (tag_id,)).fetchone()[0]
+    return connection.execute(
+        "SELECT content.ID " + MATCHING_QUERY + " LIMIT 1 OFFSET ?", (tag_id, random.randrange(count))
+    ).fetchall()
+
+
+class InlineExecutor:
+    async def run(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+
+class InlinePool:
+    # hands the benchmark's only connection to the background refills
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def call(self, func, *args, **kwargs):
+        return func(*args, connection=self.connection, **kwargs)
+
+
+def make_candidate_pool(batch_size):
+    pools = dict()
+
+    def load_batch(tag_id, limit, connection):
+        return connection.execute(
+            "SELECT content.ID " + MATCHING_QUERY + " ORDER BY RANDOM() LIMIT ?", (tag_id, limit)
+        ).fetchall()
+
+    async def candidate_pool(connection, tag_id):
+        pool = pools.get(connection)
+        if pool is None:
+            pool = pools[connection] = CandidatePool(
+                InlineExecutor(), InlinePool(connection), batch_size, batch_size // 10, ttl=float("inf"), max_keys=16
+            )
+        return await pool.pick(tag_id, functools.partial(load_batch, tag_id), connection)
+
+    return candidate_pool
+
+
+async def measure(strategy, connection, tag_id, picks):
+    timings = []
+    picked = collections.Counter()
+    for i in range(picks):
+        start = time.perf_counter()
+        if asyncio.iscoroutinefunction(strategy):
+            rows = await strategy(connection, tag_id)
+        else:
+            rows = strategy(connection, tag_id)
+        timings.append(time.perf_counter() - start)
+        picked[rows[0][0]] += 1
+        # lets background refills of the candidate pool run between commands
+        await asyncio.sleep(0)
+    return timings, picked
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare random pick strategies on a synthetic library.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--picks", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--rating", choices=RATING_TAGS.keys(), default="safe")
+    args = parser.parse_args()
+
+    tag_id = RATING_TAGS[args.rating]
+    for size in args.sizes:
+        start = time.perf_counter()
+        connection = make_library(size)
+        matching = connection.execute("SELECT COUNT(*) " + MATCHING_QUERY, (tag_id,)).fetchone()[0]
+        print("library of {} items, {} match '{}' (generated in {:.1f} s)".format(
+            size, matching, args.rating, time.perf_counter() - start
+        ))
+        strategies = [
+            ("ORDER BY RANDOM() LIMIT 1", order_by_random),
+            ("random OFFSET by COUNT", random_offset),
+            ("candidate pool of {}".format(args.batch_size), make_candidate_pool(args.batch_size)),
+        ]
+        for name, strategy in strategies:
+            timings, picked = asyncio.run(measure(strategy, connection, tag_id, args.picks))
+            timings.sort()
+            print("  {:<28} mean {:9.3f} ms  p50 {:9.3f} ms  p99 {:9.3f} ms  distinct {}/{}".format(
+                name,
+                statistics.fmean(timings) * 1000,
+                timings[len(timings) // 2] * 1000,
+                timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000,
+                len(picked),
+                args.picks
+            ))
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
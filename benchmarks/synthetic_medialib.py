@@ -0,0 +1,364 @@
+import enum
+import json
+import pathlib
+import random
+import re
+import sqlite3
+import time
+import types
+
+from PIL import Image
+
+# SQLite backed stand-in for the parts of medialib_db the bot uses, over a generated library
+# of real image files. handler_benchmark.py installs it as the medialib_db module, so the
+# handlers in main.py run unchanged. Postgres placeholders and ANY() in the bot's own SQL
+# (tag_search.py) are translated on the fly.
+
+RATING_TAGS = ["safe", "suggestive", "explicit"]
+RATING_WEIGHTS = [0.6, 0.25, 0.15]
+ORIENTATION_TAGS = ["gay", "lesbian", "solo male"]
+GENERAL_TAGS = 500
+FORMATS = ["jpeg", "png", "webp", "srs"]
+FILES_PER_FORMAT = 8
+IMAGE_SIZE = (1600, 1200)
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS content ("
+    "ID INTEGER PRIMARY KEY, file_path TEXT, title TEXT, content_type TEXT, description TEXT, "
+    "addition_date INTEGER, origin TEXT, origin_content_id TEXT, hidden INTEGER)",
+    "CREATE TABLE IF NOT EXISTS tag (ID INTEGER PRIMARY KEY, title TEXT, category TEXT)",
+    "CREATE TABLE IF NOT EXISTS tag_alias (tag_id INTEGER, title TEXT)",
+    "CREATE TABLE IF NOT EXISTS content_tags_list (content_id INTEGER, tag_id INTEGER)",
+    "CREATE TABLE IF NOT EXISTS representations (content_id INTEGER, compatibility_level INTEGER, format TEXT, file_path TEXT)",
+    "CREATE TABLE IF NOT EXISTS users (ID INTEGER PRIMARY KEY, telegram_id INTEGER UNIQUE, username TEXT, access_level INTEGER)",
+    "CREATE TABLE IF NOT EXISTS chats (ID INTEGER PRIMARY KEY, chat_id INTEGER UNIQUE, title TEXT, access_level INTEGER)",
+    "CREATE TABLE IF NOT EXISTS posts (ID INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, content_id INTEGER)",
+    "CREATE INDEX IF NOT EXISTS content_tags_list_tag ON content_tags_list (tag_id, content_id)",
+    "CREATE INDEX IF NOT EXISTS content_tags_list_content ON content_tags_list (content_id)",
+    "CREATE INDEX IF NOT EXISTS tag_alias_title ON tag_alias (title)",
+    "CREATE INDEX IF NOT EXISTS tag_title ON tag (title)",
+]
+
+
+class ACCESS_LEVEL(enum.IntEnum):
+    BAN = 0
+    SAFE = 1
+    SUGGESTIVE = 2
+    NSFW = 3
+    GAY = 4
+
+
+# access level of users and chats registered by the benchmark
+DEFAULT_ACCESS_LEVEL = ACCESS_LEVEL.NSFW
+
+User = types.SimpleNamespace
+TGChat = types.SimpleNamespace
+Representation = types.SimpleNamespace
+
+config = types.SimpleNamespace(relative_to=pathlib.Path("."))
+_database_path = None
+
+
+def configure(directory: pathlib.Path):
+    global _database_path
+    config.relative_to = pathlib.Path(directory)
+    _database_path = config.relative_to.joinpath("medialib.sqlite")
+
+
+_PLACEHOLDER = re.compile(r"%s")
+_ANY = re.compile(r"=\s*ANY\(\?\)")
+_LIKE = re.compile(r"LIKE \?")
+
+
+def _translate(query: str) -> str:
+    query = _PLACEHOLDER.sub("?", query)
+    query = _ANY.sub("IN (SELECT value FROM json_each(?))", query)
+    return _LIKE.sub("LIKE ? ESCAPE '\\\\'", query)
+
+
+def _parameters(parameters):
+    return [json.dumps(value) if isinstance(value, (list, tuple)) else value for value in parameters or ()]
+
+
+class Cursor:
+    def __init__(self, cursor: sqlite3.Cursor):
+        self._cursor = cursor
+
+    def execute(self, query, parameters=None):
+        self._cursor.execute(_translate(query), _parameters(parameters))
+        return self
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def close(self):
+        self._cursor.close()
+
+
+class Connection:
+    # psycopg2 like connection over SQLite.
+    def __init__(self, path):
+        self._connection = sqlite3.connect(str(path), check_same_thread=False, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+
+    def cursor(self):
+        return Cursor(self._connection.cursor())
+
+    def commit(self):
+        self._connection.commit()
+
+    def rollback(self):
+        self._connection.rollback()
+
+    def close(self):
+        self._connection.close()
+
+
+def make_connection():
+    return Connection(_database_path)
+
+
+common = types.SimpleNamespace(make_connection=make_connection)
+
+
+class ORDERING_BY(enum.Enum):
+    NONE = enum.auto()
+    RANDOM = enum.auto()
+    DATE_DECREASING = enum.auto()
+    DATE_INCREASING = enum.auto()
+
+
+class HIDDEN_FILTERING(enum.Enum):
+    FILTER = enum.auto()
+    ONLY_HIDDEN = enum.auto()
+    SHOW = enum.auto()
+
+
+ORDER_CLAUSES = {
+    ORDERING_BY.NONE: "",
+    ORDERING_BY.RANDOM: " ORDER BY RANDOM()",
+    ORDERING_BY.DATE_DECREASING: " ORDER BY content.addition_date DESC, content.ID DESC",
+    ORDERING_BY.DATE_INCREASING: " ORDER BY content.addition_date, content.ID",
+}
+HIDDEN_CONDITIONS = {
+    HIDDEN_FILTERING.FILTER: "content.hidden = 0",
+    HIDDEN_FILTERING.ONLY_HIDDEN: "content.hidden = 1",
+    HIDDEN_FILTERING.SHOW: "1 = 1",
+}
+
+
+def _tag_id(connection: sqlite3.Connection, tag):
+    if type(tag) is int:
+        return tag
+    row = connection.execute(
+        "SELECT ID FROM tag WHERE title = ? UNION ALL SELECT tag_id FROM tag_alias WHERE title = ? LIMIT 1",
+        (tag, tag)
+    ).fetchone()
+    return None if row is None else row[0]
+
+
+def get_media_by_tags(*tags_groups, limit=10, offset=0, order_by=ORDERING_BY.NONE,
+                      filter_hidden=HIDDEN_FILTERING.FILTER, connection=None):
+    # Every tag of a group is required, NOT groups exclude what carries all of their tags.
+    own_connection = connection is None
+    if own_connection:
+        connection = make_connection()
+    sqlite_connection = connection._connection
+    try:
+        conditions = [HIDDEN_CONDITIONS[filter_hidden]]
+        parameters = []
+        for group in tags_groups:
+            tag_ids = [_tag_id(sqlite_connection, tag) for tag in group["tags"] if tag != ""]
+            if None in tag_ids:
+                if group["not"]:
+                    continue
+                return []
+            if len(tag_ids) == 0:
+                continue
+            conditions.append(
+                "content.ID {} IN (SELECT content_id FROM content_tags_list WHERE tag_id IN ({}) "
+                "GROUP BY content_id HAVING COUNT(DISTINCT tag_id) = ?)".format(
+                    "NOT" if group["not"] else "", ", ".join("?" * len(tag_ids))
+                )
+            )
+            parameters.extend(tag_ids)
+            parameters.append(len(set(tag_ids)))
+        query = "SELECT content.ID, content.file_path, content.content_type, content.title FROM content WHERE {}{} LIMIT ? OFFSET ?".format(
+            " AND ".join(conditions), ORDER_CLAUSES[order_by]
+        )
+        return sqlite_connection.execute(query, parameters + [limit, offset]).fetchall()
+    finally:
+        if own_connection:
+            connection.close()
+
+
+files_by_tag_search = types.SimpleNamespace(
+    get_media_by_tags=get_media_by_tags, ORDERING_BY=ORDERING_BY, HIDDEN_FILTERING=HIDDEN_FILTERING
+)
+
+
+def get_content_metadata_by_content_id(content_id, connection):
+    return connection._connection.execute(
+        "SELECT ID, file_path, title, content_type, description, addition_date, origin, origin_content_id, hidden "
+        "FROM content WHERE ID = ?",
+        (content_id,)
+    ).fetchone()
+
+
+def get_representation_by_content_id(content_id, connection):
+    rows = connection._connection.execute(
+        "SELECT compatibility_level, format, file_path FROM representations "
+        "WHERE content_id = ? ORDER BY compatibility_level",
+        (content_id,)
+    ).fetchall()
+    return [
+        Representation(compatibility_level=row[0], format=row[1], file_path=config.relative_to.joinpath(row[2]))
+        for row in rows
+    ]
+
+
+def srs_update_representations(content_id, file_path, cursor):
+    with open(file_path, "r") as f:
+        srs = json.load(f)
+    for level, representation in enumerate(srs["representations"]):
+        cursor.execute(
+            "INSERT INTO representations VALUES (%s, %s, %s, %s)",
+            (content_id, level, representation["format"], representation["file"])
+        )
+
+
+srs_indexer = types.SimpleNamespace(srs_update_representations=srs_update_representations)
+
+
+def register_user_and_get_info(telegram_id, service, connection, username=None):
+    sqlite_connection = connection._connection
+    sqlite_connection.execute(
+        "INSERT INTO users (telegram_id, username, access_level) VALUES (?, ?, ?) "
+        "ON CONFLICT (telegram_id) DO UPDATE SET username = excluded.username",
+        (telegram_id, username, int(DEFAULT_ACCESS_LEVEL))
+    )
+    sqlite_connection.commit()
+    row = sqlite_connection.execute(
+        "SELECT ID, access_level FROM users WHERE telegram_id = ?", (telegram_id,)
+    ).fetchone()
+    return User(id=row[0], telegram_id=telegram_id, username=username, access_level=ACCESS_LEVEL(row[1]))
+
+
+def register_channel_and_get_info(chat_id, title, connection):
+    sqlite_connection = connection._connection
+    sqlite_connection.execute(
+        "INSERT INTO chats (chat_id, title, access_level) VALUES (?, ?, ?) "
+        "ON CONFLICT (chat_id) DO UPDATE SET title = excluded.title",
+        (chat_id, title, int(DEFAULT_ACCESS_LEVEL))
+    )
+    sqlite_connection.commit()
+    row = sqlite_connection.execute("SELECT ID, access_level FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+    return TGChat(id=row[0], chat_id=chat_id, title=title, access_level=ACCESS_LEVEL(row[1]))
+
+
+def register_post(user_id, content_id, connection):
+    cursor = connection._connection.execute(
+        "INSERT INTO posts (user_id, content_id) VALUES (?, ?)", (user_id, content_id)
+    )
+    connection.commit()
+    return cursor.lastrowid
+
+
+def get_post(post_id, connection):
+    return connection._connection.execute(
+        "SELECT ID, user_id, content_id FROM posts WHERE ID = ?", (post_id,)
+    ).fetchone()
+
+
+def posts_by_telegram_user(connection) -> dict:
+    posts = dict()
+    for post_id, telegram_id in connection._connection.execute(
+            "SELECT posts.ID, users.telegram_id FROM posts JOIN users ON users.ID = posts.user_id"
+    ):
+        posts.setdefault(telegram_id, []).append(post_id)
+    return posts
+
+
+def _make_image(rng: random.Random) -> Image.Image:
+    # A noisy gradient, so encoders have real work to do.
+    base = Image.linear_gradient("L").resize(IMAGE_SIZE)
+    noise = Image.effect_noise(IMAGE_SIZE, rng.randint(20, 80))
+    return Image.merge("RGB", (base, noise, base.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+
+
+def _make_files(directory: pathlib.Path, rng: random.Random) -> dict:
+    files = {image_format: [] for image_format in FORMATS}
+    pictures = directory.joinpath("pictures")
+    pictures.mkdir(parents=True, exist_ok=True)
+    for i in range(FILES_PER_FORMAT):
+        image = _make_image(rng)
+        image.save(pictures.joinpath("{}.jpeg".format(i)), "JPEG", quality=90)
+        image.save(pictures.joinpath("{}.png".format(i)), "PNG")
+        image.save(pictures.joinpath("{}.webp".format(i)), "WEBP", quality=90)
+        image.save(pictures.joinpath("{}.srs.webp".format(i)), "WEBP", quality=80)
+        with pictures.joinpath("{}.srs".format(i)).open("w") as f:
+            json.dump({"representations": [
+                {"format": "png", "file": "pictures/{}.png".format(i)},
+                {"format": "webp", "file": "pictures/{}.srs.webp".format(i)},
+            ]}, f)
+        for image_format in FORMATS:
+            files[image_format].append("pictures/{}.{}".format(i, image_format))
+    return files
+
+
+def build_dataset(directory, size: int, seed: int = 637):
+    # Creates the library once, an existing one of the same size is reused.
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    configure(directory)
+    if _database_path.exists():
+        connection = sqlite3.connect(str(_database_path))
+        try:
+            existing_size = connection.execute("SELECT COUNT(*) FROM content").fetchone()[0]
+        except sqlite3.OperationalError:
+            existing_size = None
+        connection.close()
+        if existing_size == size:
+            return
+        _database_path.unlink()
+    connection = sqlite3.connect(str(_database_path))
+    for statement in SCHEMA:
+        connection.execute(statement)
+    rng = random.Random(seed)
+    files = _make_files(directory, rng)
+    tags = [(i + 1, title, "rating") for i, title in enumerate(RATING_TAGS)]
+    tags += [(10 + i, title, "content") for i, title in enumerate(ORIENTATION_TAGS)]
+    tags += [(100 + i, "tag {}".format(i), "content") for i in range(GENERAL_TAGS)]
+    connection.executemany("INSERT INTO tag VALUES (?, ?, ?)", tags)
+    connection.executemany(
+        "INSERT INTO tag_alias VALUES (?, ?)", [(tag_id, title.replace(" ", "_")) for tag_id, title, _ in tags]
+    )
+    content_rows = []
+    tag_rows = []
+    now = int(time.time())
+    for content_id in range(1, size + 1):
+        image_format = FORMATS[content_id % len(FORMATS)]
+        content_rows.append((
+            content_id,
+            rng.choice(files[image_format]),
+            "Synthetic image {}".format(content_id),
+            "image",
+            None,
+            now - content_id * 60,
+            "derpibooru",
+            str(content_id),
+            int(rng.random() < 0.02)
+        ))
+        rating = rng.choices(range(1, len(RATING_TAGS) + 1), RATING_WEIGHTS)[0]
+        tag_rows.append((content_id, rating))
+        if rng.random() < 0.1:
+            tag_rows.append((content_id, rng.randrange(10, 10 + len(ORIENTATION_TAGS))))
+        for tag_id in rng.sample(range(100, 100 + GENERAL_TAGS), 5):
+            tag_rows.append((content_id, tag_id))
+    connection.executemany("INSERT INTO content VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", content_rows)
+    connection.executemany("INSERT INTO content_tags_list VALUES (?, ?)", tag_rows)
+    connection.commit()
+    connection.close()
@@ -0,0 +1,92 @@
+import os
+
+import secrets
+
+# sharded_bot.py tells its workers how many of them there are, the defaults of the per
+# process resources below are divided between them
+SHARDS_ENVIRONMENT_VARIABLE = "MEDIALIB_BOT_SHARDS"
+SHARDS = int(os.environ.get(SHARDS_ENVIRONMENT_VARIABLE, 1))
+
+DB_WORKERS = getattr(secrets, "db_workers", max(1, 8 // SHARDS))
+DB_MAX_CONCURRENCY = getattr(secrets, "db_max_concurrency", DB_WORKERS)
+DB_CALL_TIMEOUT = getattr(secrets, "db_call_timeout", 30)
+
+DB_POOL_MIN_SIZE = getattr(secrets, "db_pool_min_size", 1)
+DB_POOL_MAX_SIZE = getattr(secrets, "db_pool_max_size", DB_MAX_CONCURRENCY)
+DB_POOL_MAX_IDLE_TIME = getattr(secrets, "db_pool_max_idle_time", 300)
+DB_POOL_HEALTH_CHECK_AFTER = getattr(secrets, "db_pool_health_check_after", 30)
+
+FILE_ID_CACHE_PATH = getattr(secrets, "file_id_cache_path", "bot_cache.sqlite")
+
+TRANSCODER_WORKERS = getattr(secrets, "transcoder_workers", max(1, (os.cpu_count() or 1) // SHARDS))
+TRANSCODER_QUEUE_DEPTH = getattr(secrets, "transcoder_queue_depth", TRANSCODER_WORKERS * 2)
+# bytes of decoded pixels one preview may take, larger images are sent without a preview
+PREVIEW_MEMORY_BUDGET = getattr(secrets, "preview_memory_budget", 512 * 1024 ** 2)
+ANIMATED_PREVIEW_MAX_FRAMES = getattr(secrets, "animated_preview_max_frames", 50)
+ANIMATED_PREVIEW_MEMORY_BUDGET = getattr(secrets, "animated_preview_memory_budget", 64 * 1024 ** 2)
+
+PREVIEW_CACHE_DIR = getattr(secrets, "preview_cache_dir", "preview_cache")
+PREVIEW_CACHE_MAX_SIZE = getattr(secrets, "preview_cache_max_size", 1024 ** 3)
+
+CANDIDATE_BATCH_SIZE = getattr(secrets, "candidate_batch_size", 200)
+CANDIDATE_LOW_WATERMARK = getattr(secrets, "candidate_low_watermark", CANDIDATE_BATCH_SIZE // 10)
+CANDIDATE_TTL = getattr(secrets, "candidate_ttl", 600)
+CANDIDATE_POOL_MAX_QUERIES = getattr(secrets, "candidate_pool_max_queries", 1000)
+
+# messages per second
+GLOBAL_MESSAGE_RATE = getattr(secrets, "global_message_rate", 30 / SHARDS)
+PRIVATE_CHAT_MESSAGE_RATE = getattr(secrets, "private_chat_message_rate", 1)
+GROUP_CHAT_MESSAGE_RATE = getattr(secrets, "group_chat_message_rate", 20 / 60)
+CHAT_MESSAGE_BURST = getattr(secrets, "chat_message_burst", 3)
+
+TAG_SEARCH_PAGE_SIZE = getattr(secrets, "tag_search_page_size", 100)
+
+# inline mode: results per answer (Telegram allows at most 50) and seconds Telegram may cache them
+INLINE_PAGE_SIZE = getattr(secrets, "inline_page_size", 50)
+INLINE_CACHE_TIME = getattr(secrets, "inline_cache_time", 300)
+# search rows one answer may read past without finding an already sent image
+INLINE_MAX_SCANNED = getattr(secrets, "inline_max_scanned", 1000)
+
+ACCESS_CACHE_SIZE = getattr(secrets, "access_cache_size", 10000)
+ACCESS_CACHE_TTL = getattr(secrets, "access_cache_ttl", 300)
+
+POST_WRITE_BEHIND = getattr(secrets, "post_write_behind", False)
+POST_TABLE = getattr(secrets, "post_table", "telegram_bot_post")
+POST_ID_SEQUENCE = getattr(secrets, "post_id_sequence", POST_TABLE + "_id_seq")
+POST_ID_BLOCK_SIZE = getattr(secrets, "post_id_block_size", 100)
+POST_FLUSH_INTERVAL = getattr(secrets, "post_flush_interval", 1)
+POST_FLUSH_MAX_BATCH = getattr(secrets, "post_flush_max_batch", 500)
+POST_MAX_PENDING = getattr(secrets, "post_max_pending", 10000)
+POST_FLUSH_MAX_ATTEMPTS = getattr(secrets, "post_flush_max_attempts", 3)
+
+MAX_CONCURRENT_UPLOADS = getattr(secrets, "max_concurrent_uploads", 8)
+
+# number of updates handled at the same time
+CONCURRENT_UPDATES = getattr(secrets, "concurrent_updates", 64)
+TELEGRAM_API_BASE_URL = getattr(secrets, "telegram_api_base_url", None)
+TELEGRAM_API_BASE_FILE_URL = getattr(secrets, "telegram_api_base_file_url", None)
+
+# polling is used while WEBHOOK_URL is None
+WEBHOOK_URL = getattr(secrets, "webhook_url", None)
+WEBHOOK_LISTEN = getattr(secrets, "webhook_listen", "127.0.0.1")
+WEBHOOK_PORT = getattr(secrets, "webhook_port", 8443)
+WEBHOOK_PATH = getattr(secrets, "webhook_path", "")
+WEBHOOK_SECRET_TOKEN = getattr(secrets, "webhook_secret_token", None)
+WEBHOOK_MAX_CONNECTIONS = getattr(secrets, "webhook_max_connections", 40)
+
+# sharded_bot.py: number of worker processes, None means one per CPU core
+SHARD_WORKERS = getattr(secrets, "shard_workers", None)
+SHARD_QUEUE_SIZE = getattr(secrets, "shard_queue_size", 1000)
+SHARD_RESTART_DELAY = getattr(secrets, "shard_restart_delay", 5)
+SHARD_STATS_INTERVAL = getattr(secrets, "shard_stats_interval", 60)
+
+# tag title -> id dictionary: new tags are fetched every TAG_RESOLVER_REFRESH_INTERVAL seconds,
+# everything is reloaded every TAG_RESOLVER_RELOAD_INTERVAL seconds
+TAG_RESOLVER_REFRESH_INTERVAL = getattr(secrets, "tag_resolver_refresh_interval", 60)
+TAG_RESOLVER_RELOAD_INTERVAL = getattr(secrets, "tag_resolver_reload_interval", 3600)
+UNKNOWN_TAG_TTL = getattr(secrets, "unknown_tag_ttl", 60)
+UNKNOWN_TAG_CACHE_SIZE = getattr(secrets, "unknown_tag_cache_size", 10000)
+
+# Prometheus metrics on http://METRICS_LISTEN:METRICS_PORT/metrics, disabled while None
+METRICS_LISTEN = getattr(secrets, "metrics_listen", "127.0.0.1")
+METRICS_PORT = getattr(secrets, "metrics_port", None)
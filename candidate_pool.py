@@ -0,0 +1,98 @@
+import asyncio
+import collections
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_tags_groups(tags_groups) -> tuple:
+    # query_parser output as a hashable key: empty tags are dropped and neither the order of
+    # tags inside a group nor the order of groups changes the key.
+    groups = []
+    for group in tags_groups:
+        tags = tuple(sorted((tag for tag in group["tags"] if tag != ""), key=repr))
+        if len(tags):
+            groups.append((group["not"], tags))
+    return tuple(sorted(groups, key=repr))
+
+
+class CandidatePool:
+    # Keeps a batch of random search results per query key. Commands take rows from the
+    # batch; when fewer than low_watermark rows are left a refill is loaded in the background,
+    # so most commands are answered without a search. Rows of an ORDER BY RANDOM batch are
+    # uniform picks from the matching set. Batches expire after ttl seconds and at most
+    # max_keys queries are kept, least recently used first out. load_batch(limit, connection)
+    # runs a search; on a miss it gets the caller's connection, refills borrow one from the pool.
+    def __init__(self, db, pool, batch_size: int, low_watermark: int, ttl: float, max_keys: int):
+        self._db = db
+        self._pool = pool
+        self.batch_size = batch_size
+        self.low_watermark = low_watermark
+        self.ttl = ttl
+        self.max_keys = max_keys
+        # key -> (loaded_at, deque of rows)
+        self._batches = collections.OrderedDict()
+        self._refills = {}
+        # key -> future of the search a miss is running, resolved to the number of rows found
+        self._loads = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, key, rows):
+        self._batches[key] = (time.monotonic(), collections.deque(rows))
+        self._batches.move_to_end(key)
+        while len(self._batches) > self.max_keys:
+            self._batches.popitem(last=False)
+
+    async def _refill(self, key, load_batch):
+        try:
+            rows = await self._pool.call(load_batch, self.batch_size)
+        except Exception:
+            logger.exception("candidate pool refill failed")
+            return
+        finally:
+            del self._refills[key]
+        batch = self._batches.get(key)
+        if batch is not None and time.monotonic() - batch[0] <= self.ttl:
+            rows = list(batch[1]) + [row for row in rows if row not in batch[1]]
+        self._store(key, rows)
+
+    async def pick(self, key, load_batch, connection, count=1):
+        # Returns up to count distinct rows. A batch with fewer rows left is loaded again.
+        batch = self._batches.get(key)
+        if batch is not None and (time.monotonic() - batch[0] > self.ttl or len(batch[1]) < count):
+            del self._batches[key]
+            batch = None
+        if batch is None:
+            load = self._loads.get(key)
+            if load is not None:
+                # another caller is searching this key already, take from its batch
+                found = await asyncio.shield(load)
+                if found == 0:
+                    return []
+                return await self.pick(key, load_batch, connection, count)
+            self.misses += 1
+            load = self._loads[key] = asyncio.get_running_loop().create_future()
+            found = None
+            try:
+                rows = collections.deque(await self._db.run(load_batch, max(self.batch_size, count), connection))
+                found = len(rows)
+            finally:
+                del self._loads[key]
+                # a failed search lets the next waiter search again
+                load.set_result(found)
+            if len(rows) == 0:
+                return []
+            picked = [rows.popleft() for i in range(min(count, len(rows)))]
+            self._store(key, rows)
+            return picked
+        self.hits += 1
+        self._batches.move_to_end(key)
+        picked = [batch[1].popleft() for i in range(count)]
+        if len(batch[1]) < self.low_watermark and key not in self._refills:
+            self._refills[key] = asyncio.create_task(self._refill(key, load_batch))
+        return picked
+
+    def clear(self):
+        self._batches.clear()
@@ -0,0 +1,84 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class DBCallTimeout(Exception):
+    pass
+
+
+class DBExecutor:
+    # Runs blocking medialib_db calls on a thread pool, so the asyncio loop keeps serving other chats.
+    # The semaphore bounds how many calls may be in flight at once, including the ones still queued
+    # inside the thread pool. A call that timed out or whose caller got cancelled keeps its slot
+    # until the thread is done with it.
+    def __init__(self, max_workers: int, max_concurrency: int, timeout: float):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="medialib_db"
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.timeout = timeout
+        # still running calls nobody waits for anymore -> their arguments
+        self._abandoned = dict()
+
+    def _call_done(self, loop, future):
+        # runs in the worker thread
+        try:
+            loop.call_soon_threadsafe(self._free_slot, future)
+        except RuntimeError:
+            # the event loop is closed already
+            pass
+
+    def _free_slot(self, future):
+        self._abandoned.pop(future, None)
+        self._semaphore.release()
+
+    async def run(self, func, *args, timeout: float = None, abandoned=None, **kwargs):
+        # abandoned is called with the concurrent future of a call whose result the caller won't
+        # get because it timed out or got cancelled, e.g. to clean up that result later.
+        if timeout is None:
+            timeout = self.timeout
+        loop = asyncio.get_running_loop()
+        await self._semaphore.acquire()
+        try:
+            # the call runs in the caller's context, so per request state like metrics traces is kept
+            future = self._executor.submit(contextvars.copy_context().run, func, *args, **kwargs)
+        except BaseException:
+            self._semaphore.release()
+            raise
+        future.add_done_callback(functools.partial(self._call_done, loop))
+        waiter = asyncio.wrap_future(future)
+        try:
+            done, pending = await asyncio.wait({waiter}, timeout=timeout)
+        except asyncio.CancelledError:
+            self._abandon(future, waiter, args, kwargs, abandoned)
+            raise
+        if len(done) == 0:
+            self._abandon(future, waiter, args, kwargs, abandoned)
+            # functools.partial has no __qualname__
+            name = getattr(func, "__qualname__", repr(func))
+            logger.warning("medialib_db call {} timed out after {} s".format(name, timeout))
+            raise DBCallTimeout(name)
+        return waiter.result()
+
+    def _abandon(self, future, waiter, args, kwargs, abandoned):
+        # nobody retrieves the outcome of the waiter anymore
+        waiter.add_done_callback(lambda waiter: waiter.cancelled() or waiter.exception())
+        if not future.done():
+            self._abandoned[future] = tuple(args) + tuple(kwargs.values())
+        if abandoned is not None:
+            abandoned(future)
+
+    def busy_future(self, obj):
+        # The still running abandoned call that got obj, e.g. a connection, as an argument.
+        for future, arguments in self._abandoned.items():
+            if not future.done() and any(argument is obj for argument in arguments):
+                return future
+        return None
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
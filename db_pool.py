@@ -0,0 +1,263 @@
+import asyncio
+import collections
+import functools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    # Thread safe pool of DB-API connections. acquire() blocks, the bot checks connections out
+    # through AsyncConnectionPool, which only calls it once a connection is free.
+    def __init__(
+            self,
+            connection_factory,
+            min_size: int = 1,
+            max_size: int = 8,
+            max_idle_time: float = 300,
+            checkout_timeout: float = 30,
+            health_check_after: float = 30
+    ):
+        self._connection_factory = connection_factory
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle_time = max_idle_time
+        self.checkout_timeout = checkout_timeout
+        # connections idle for longer are checked with SELECT 1 before they are handed out
+        self.health_check_after = health_check_after
+
+        self._condition = threading.Condition()
+        # (connection, returned_at) pairs, most recently returned on the right
+        self._idle = collections.deque()
+        self._size = 0
+        self._closed = False
+
+        self.in_use = 0
+        self.waiting = 0
+        self.created = 0
+        self.discarded = 0
+
+    def fill(self):
+        while True:
+            with self._condition:
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                connection = self._connect()
+            except Exception:
+                with self._condition:
+                    self._size -= 1
+                    self._condition.notify()
+                raise
+            with self._condition:
+                self._idle.append((connection, time.monotonic()))
+                self._condition.notify()
+
+    def _connect(self):
+        connection = self._connection_factory()
+        with self._condition:
+            self.created += 1
+        return connection
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self._condition:
+            self._size -= 1
+            self.discarded += 1
+            self._condition.notify()
+
+    @staticmethod
+    def _is_healthy(connection) -> bool:
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            cursor.close()
+            connection.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _take_idle(self):
+        # Called with the condition held. Drops connections that were idle for too long,
+        # keeping at least min_size of them open.
+        now = time.monotonic()
+        while len(self._idle) and self._size > self.min_size \
+                and now - self._idle[0][1] > self.max_idle_time:
+            connection, returned_at = self._idle.popleft()
+            self._size -= 1
+            self.discarded += 1
+            try:
+                connection.close()
+            except Exception:
+                pass
+        if len(self._idle):
+            return self._idle.pop()
+        return None
+
+    def acquire(self):
+        deadline = time.monotonic() + self.checkout_timeout
+        while True:
+            with self._condition:
+                connection = None
+                returned_at = None
+                while True:
+                    if self._closed:
+                        raise PoolTimeout("connection pool is closed")
+                    idle = self._take_idle()
+                    if idle is not None:
+                        connection, returned_at = idle
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout("no free medialib_db connection in {} s".format(self.checkout_timeout))
+                    self.waiting += 1
+                    try:
+                        self._condition.wait(remaining)
+                    finally:
+                        self.waiting -= 1
+                self.in_use += 1
+            if connection is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self._condition:
+                        self._size -= 1
+                        self.in_use -= 1
+                        self._condition.notify()
+                    raise
+            if time.monotonic() - returned_at <= self.health_check_after or self._is_healthy(connection):
+                return connection
+            logger.info("discard broken medialib_db connection")
+            with self._condition:
+                self.in_use -= 1
+            self._discard(connection)
+
+    def release(self, connection):
+        try:
+            connection.rollback()
+            healthy = True
+        except Exception:
+            healthy = False
+        with self._condition:
+            self.in_use -= 1
+            if healthy and not self._closed:
+                self._idle.append((connection, time.monotonic()))
+                self._condition.notify()
+                return
+        self._discard(connection)
+
+    def call(self, func, *args, **kwargs):
+        connection = self.acquire()
+        try:
+            return func(*args, connection=connection, **kwargs)
+        finally:
+            self.release(connection)
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self.in_use,
+                "waiting": self.waiting,
+                "created": self.created,
+                "discarded": self.discarded,
+            }
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._condition.notify_all()
+        for connection, returned_at in idle:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+
+class AsyncConnectionPool:
+    # Event loop side of a ConnectionPool. Callers wait for a free connection here before they
+    # take a DBExecutor thread: a checkout blocked inside a thread would hold the executor slot
+    # the holders of connections need to finish and release them. Connections a timed out call
+    # still uses, or gets only after its caller gave up, are returned when that call is over.
+    def __init__(self, pool: ConnectionPool, db):
+        self.pool = pool
+        self._db = db
+        self._free = asyncio.Semaphore(pool.max_size)
+
+    def _free_late(self, loop, future=None):
+        try:
+            loop.call_soon_threadsafe(self._free.release)
+        except RuntimeError:
+            # the event loop is closed already
+            pass
+
+    def _acquired_late(self, loop, future):
+        if not future.cancelled() and future.exception() is None:
+            self.pool.release(future.result())
+        self._free_late(loop)
+
+    def _release_late(self, loop, connection, future):
+        self.pool.release(connection)
+        self._free_late(loop)
+
+    async def acquire(self):
+        try:
+            await asyncio.wait_for(self._free.acquire(), self.pool.checkout_timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeout("no free medialib_db connection in {} s".format(self.pool.checkout_timeout))
+        loop = asyncio.get_running_loop()
+        late = []
+
+        def acquired_late(future):
+            late.append(future)
+            future.add_done_callback(functools.partial(self._acquired_late, loop))
+
+        try:
+            return await self._db.run(self.pool.acquire, abandoned=acquired_late)
+        except BaseException:
+            if len(late) == 0:
+                self._free.release()
+            raise
+
+    async def release(self, connection):
+        loop = asyncio.get_running_loop()
+        busy = self._db.busy_future(connection)
+        if busy is not None:
+            busy.add_done_callback(functools.partial(self._release_late, loop, connection))
+            return
+        late = []
+
+        def released_late(future):
+            late.append(future)
+            future.add_done_callback(functools.partial(self._free_late, loop))
+
+        try:
+            await self._db.run(self.pool.release, connection, abandoned=released_late)
+        finally:
+            if len(late) == 0:
+                self._free.release()
+
+    async def call(self, func, *args, **kwargs):
+        connection = await self.acquire()
+        try:
+            return await self._db.run(func, *args, connection=connection, **kwargs)
+        finally:
+            await self.release(connection)
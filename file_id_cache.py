@@ -0,0 +1,88 @@
+import os
+import pathlib
+import sqlite3
+import threading
+
+PHOTO = "photo"
+
+
+def file_fingerprint(file_path: pathlib.Path):
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class FileIDCache:
+    # Maps (content_id, upload kind) to the file_id Telegram returned for the upload.
+    # Entries remember the mtime and size of the content file and are ignored once it changes.
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(path), check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS telegram_file_id ("
+            "content_id INTEGER NOT NULL, "
+            "kind TEXT NOT NULL, "
+            "file_id TEXT NOT NULL, "
+            "source_mtime_ns INTEGER, "
+            "source_size INTEGER, "
+            "PRIMARY KEY (content_id, kind))"
+        )
+        self._connection.commit()
+
+    def get(self, content_id: int, kind: str, fingerprint):
+        if fingerprint is None:
+            return None
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT file_id, source_mtime_ns, source_size FROM telegram_file_id "
+                "WHERE content_id = ? AND kind = ?",
+                (content_id, kind)
+            ).fetchone()
+        if row is None or (row[1], row[2]) != tuple(fingerprint):
+            return None
+        return row[0]
+
+    def get_many(self, fingerprints: dict, kind: str) -> dict:
+        # fingerprints maps content ids to the current fingerprints of their files,
+        # returns content id -> file_id of the entries that are still valid.
+        content_ids = [content_id for content_id, fingerprint in fingerprints.items() if fingerprint is not None]
+        if len(content_ids) == 0:
+            return dict()
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT content_id, file_id, source_mtime_ns, source_size FROM telegram_file_id "
+                "WHERE kind = ? AND content_id IN ({})".format(", ".join("?" * len(content_ids))),
+                [kind] + content_ids
+            ).fetchall()
+        return {
+            row[0]: row[1] for row in rows if (row[2], row[3]) == tuple(fingerprints[row[0]])
+        }
+
+    def put(self, content_id: int, kind: str, fingerprint, file_id: str):
+        if fingerprint is None:
+            return
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO telegram_file_id "
+                "(content_id, kind, file_id, source_mtime_ns, source_size) VALUES (?, ?, ?, ?, ?)",
+                (content_id, kind, file_id, fingerprint[0], fingerprint[1])
+            )
+            self._connection.commit()
+
+    def invalidate(self, content_id: int, kind: str = None):
+        with self._lock:
+            if kind is None:
+                self._connection.execute("DELETE FROM telegram_file_id WHERE content_id = ?", (content_id,))
+            else:
+                self._connection.execute(
+                    "DELETE FROM telegram_file_id WHERE content_id = ? AND kind = ?", (content_id, kind)
+                )
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,75 @@
+import sqlite3
+import threading
+
+import pyimglib
+
+from file_id_cache import file_fingerprint
+
+NOT_JPEG = 0
+HUFFMAN = 1
+ARITHMETIC = 2
+
+
+def probe_jpeg(file_path) -> int:
+    if not pyimglib.decoders.jpeg.is_JPEG(file_path):
+        return NOT_JPEG
+    jpeg = pyimglib.decoders.jpeg.JPEGDecoder(file_path)
+    try:
+        if jpeg.arithmetic_coding():
+            return ARITHMETIC
+    except ValueError:
+        return ARITHMETIC
+    return HUFFMAN
+
+
+class JPEGProbeCache:
+    # Remembers probe_jpeg() results per content id, so arithmetic coding is detected once
+    # per file instead of on every request.
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(path), check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS jpeg_probe ("
+            "content_id INTEGER PRIMARY KEY, "
+            "coding INTEGER NOT NULL, "
+            "source_mtime_ns INTEGER, "
+            "source_size INTEGER)"
+        )
+        self._connection.commit()
+
+    def get(self, content_id: int, fingerprint):
+        if fingerprint is None:
+            return None
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT coding, source_mtime_ns, source_size FROM jpeg_probe WHERE content_id = ?",
+                (content_id,)
+            ).fetchone()
+        if row is None or (row[1], row[2]) != tuple(fingerprint):
+            return None
+        return row[0]
+
+    def put(self, content_id: int, fingerprint, coding: int):
+        if fingerprint is None:
+            return
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO jpeg_probe (content_id, coding, source_mtime_ns, source_size) "
+                "VALUES (?, ?, ?, ?)",
+                (content_id, coding, fingerprint[0], fingerprint[1])
+            )
+            self._connection.commit()
+
+    def probe(self, content_id: int, file_path) -> int:
+        fingerprint = file_fingerprint(file_path)
+        coding = self.get(content_id, fingerprint)
+        if coding is None:
+            coding = probe_jpeg(file_path)
+            self.put(content_id, fingerprint, coding)
+        return coding
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
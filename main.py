@@ -1,18 +1,36 @@
+import asyncio
 import enum
-import io
+import functools
 import logging
-import time
+import os
+import pathlib
+import tempfile
 
 import telegram.error
 
-import pyimglib
-
-from telegram import Update
-from telegram.ext import filters, MessageHandler, ApplicationBuilder, CommandHandler, ContextTypes
+from telegram import Update, InlineQueryResultCachedPhoto, InputMediaPhoto
+from telegram.ext import filters, MessageHandler, ApplicationBuilder, CommandHandler, ContextTypes, InlineQueryHandler
 
 import medialib_db
 import secrets
 
+import bot_config
+from db_executor import DBExecutor, DBCallTimeout
+from db_pool import ConnectionPool, AsyncConnectionPool, PoolTimeout
+import file_id_cache
+import jpeg_probe
+import tag_search
+from transcoder import Transcoder, TranscoderBusy, TranscoderCrashed, PreviewTooLarge, ANIMATED_FORMATS
+from preview_cache import PreviewCache
+from candidate_pool import CandidatePool, normalize_tags_groups
+from message_sender import MessageSender
+from ttl_cache import TTLCache
+from post_writer import PostWriter, DirectPostWriter
+from uploader import Uploader
+import metrics
+from tag_resolver import TagResolver
+from rating_commands import RatingCommand, RatingFilters, RATING_COMMANDS, split_count
+
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
@@ -20,10 +38,91 @@ logging.basicConfig(
 
 UNKNOWN_COMMAND_TEXT_RESPONSE = "Sorry, I didn't understand that command."
 
-def get_user_data(update, connection) -> medialib_db.User:
-    return medialib_db.register_user_and_get_info(
+DB_EXECUTOR_KEY = "db_executor"
+DB_POOL_KEY = "db_pool"
+DB_CONNECTIONS_KEY = "db_connections"
+FILE_ID_CACHE_KEY = "file_id_cache"
+TRANSCODER_KEY = "transcoder"
+PREVIEW_CACHE_KEY = "preview_cache"
+JPEG_PROBE_CACHE_KEY = "jpeg_probe_cache"
+CANDIDATE_POOL_KEY = "candidate_pool"
+MESSAGE_SENDER_KEY = "message_sender"
+USER_CACHE_KEY = "user_cache"
+CHAT_CACHE_KEY = "chat_cache"
+POST_WRITER_KEY = "post_writer"
+UPLOADER_KEY = "uploader"
+RATING_FILTERS_KEY = "rating_filters"
+TAG_RESOLVER_KEY = "tag_resolver"
+METRICS_KEY = "metrics"
+
+def get_db(context) -> DBExecutor:
+    return context.bot_data[DB_EXECUTOR_KEY]
+
+def get_pool(context) -> ConnectionPool:
+    return context.bot_data[DB_POOL_KEY]
+
+def get_connections(context) -> AsyncConnectionPool:
+    return context.bot_data[DB_CONNECTIONS_KEY]
+
+def get_file_id_cache(context) -> file_id_cache.FileIDCache:
+    return context.bot_data[FILE_ID_CACHE_KEY]
+
+def get_transcoder(context) -> Transcoder:
+    return context.bot_data[TRANSCODER_KEY]
+
+def get_preview_cache(context) -> PreviewCache:
+    return context.bot_data.get(PREVIEW_CACHE_KEY)
+
+def get_jpeg_probe_cache(context) -> jpeg_probe.JPEGProbeCache:
+    return context.bot_data[JPEG_PROBE_CACHE_KEY]
+
+def get_candidate_pool(context) -> CandidatePool:
+    return context.bot_data[CANDIDATE_POOL_KEY]
+
+def get_message_sender(context) -> MessageSender:
+    return context.bot_data[MESSAGE_SENDER_KEY]
+
+def get_post_writer(context) -> PostWriter:
+    return context.bot_data[POST_WRITER_KEY]
+
+def get_uploader(context) -> Uploader:
+    return context.bot_data[UPLOADER_KEY]
+
+async def acquire_connection(context):
+    return await get_connections(context).acquire()
+
+async def release_connection(context, connection):
+    await get_connections(context).release(connection)
+
+async def call_with_connection(context, func, *args, **kwargs):
+    return await get_connections(context).call(func, *args, **kwargs)
+
+def get_rating_filters(context) -> RatingFilters:
+    return context.bot_data[RATING_FILTERS_KEY]
+
+def get_tag_resolver(context) -> TagResolver:
+    return context.bot_data[TAG_RESOLVER_KEY]
+
+def is_group_chat(update) -> bool:
+    return update.effective_chat.type != telegram.constants.ChatType.PRIVATE
+
+async def send_text(update, context, text: str):
+    return await get_message_sender(context).send_message(
+        context.bot, update.effective_chat.id, text, is_group_chat(update)
+    )
+
+def get_user_data(context, update, connection) -> medialib_db.User:
+    # Registration is an upsert, it is only repeated when the cached record is missing,
+    # expired or the username has changed.
+    user_cache = context.bot_data[USER_CACHE_KEY]
+    cached = user_cache.get(update.effective_user.id)
+    if cached is not None and cached[0] == update.effective_user.username:
+        return cached[1]
+    user_data = medialib_db.register_user_and_get_info(
         update.effective_user.id, "telegram", connection, username=update.effective_user.username
     )
+    user_cache.put(update.effective_user.id, (update.effective_user.username, user_data))
+    return user_data
 
 def get_query_from_text(text: str):
     query_data = text.split(" ", 1)
@@ -32,27 +131,48 @@ def get_query_from_text(text: str):
     else:
         return ''
 
-def get_permission_level(update, connection, user_data):
-    permission_level = user_data.access_level
-    if update.effective_chat.type != telegram.constants.ChatType.PRIVATE:
-        chat_data: medialib_db.TGChat = medialib_db.register_channel_and_get_info(
-            update.effective_chat.id, update.effective_chat.title, connection
-        )
-        permission_level = chat_data.access_level
-    return permission_level
+def get_chat_data(context, update, connection) -> medialib_db.TGChat:
+    chat_cache = context.bot_data[CHAT_CACHE_KEY]
+    cached = chat_cache.get(update.effective_chat.id)
+    if cached is not None and cached[0] == update.effective_chat.title:
+        return cached[1]
+    chat_data = medialib_db.register_channel_and_get_info(
+        update.effective_chat.id, update.effective_chat.title, connection
+    )
+    chat_cache.put(update.effective_chat.id, (update.effective_chat.title, chat_data))
+    return chat_data
+
+def invalidate_access_cache(context, telegram_user_id=None, chat_id=None):
+    if telegram_user_id is not None:
+        context.bot_data[USER_CACHE_KEY].invalidate(telegram_user_id)
+    if chat_id is not None:
+        context.bot_data[CHAT_CACHE_KEY].invalidate(chat_id)
+
+def get_permission_level(context, update, connection, user_data=None):
+    # The chat decides in group chats, the user is only looked up in private ones.
+    if is_group_chat(update):
+        return get_chat_data(context, update, connection).access_level
+    if user_data is None:
+        user_data = get_user_data(context, update, connection)
+    return user_data.access_level
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    medialib_connection = medialib_db.common.make_connection()
-    user_data = get_user_data(update, medialib_connection)
-    permission_level = get_permission_level(update, medialib_connection, user_data)
-    medialib_connection.close()
-    print("effective_chat", update.effective_chat)
-    print("effective_user", update.effective_user)
+    db = get_db(context)
+    medialib_connection = await acquire_connection(context)
+    try:
+        permission_level = await db.run(get_permission_level, context, update, medialib_connection)
+    finally:
+        await release_connection(context, medialib_connection)
+    logging.debug("start: chat {}, user {}".format(update.effective_chat, update.effective_user))
     response_lines = []
     if permission_level > medialib_db.ACCESS_LEVEL.BAN:
         response_lines.append("Welcome to @mfg637's personal media library.")
         response_lines.append("Type /safe to get random SFW image.")
+        response_lines.append("Type /safe x5 to get an album of 5 images, up to 10.")
         response_lines.append("Type /tag `tag_wildcard` to search the tag")
+        response_lines.append(
+            "Type @{} `tags` in any chat to browse images that were already sent.".format(context.bot.username)
+        )
         if permission_level >= medialib_db.ACCESS_LEVEL.SUGGESTIVE:
             response_lines.append("Type /suggestive to get suggestive image.")
             if permission_level >= medialib_db.ACCESS_LEVEL.NSFW:
@@ -60,13 +180,21 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 response_lines.append("Type /explicit to get explicit rated image.")
         response_lines.append("Type /best `POST_ID` to get best available image.")
         response_lines.append("Type /webp `POST_ID` to get WEBP image if available.")
+        response_lines.append("Type /animation `POST_ID` to get a short preview of an animation.")
+        response_lines.append("Type /refresh after your access level was changed.")
         response_lines.append("Other commands is not supported.")
     else:
         response_lines.append("You are banned. Have a nice day.")
-    await context.bot.send_message(chat_id=update.effective_chat.id, text="\n".join(response_lines))
+    await get_message_sender(context).send_lines(
+        context.bot, update.effective_chat.id, response_lines, is_group_chat(update)
+    )
+
+async def refresh(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    invalidate_access_cache(context, update.effective_user.id, update.effective_chat.id)
+    await send_text(update, context, "Access level will be reloaded.")
 
 async def default_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await context.bot.send_message(chat_id=update.effective_chat.id, text="I'm not a chatbot!")
+    await send_text(update, context, "I'm not a chatbot!")
 
 def query_parser(query:str):
     tag_groups = []
@@ -90,18 +218,24 @@ def query_parser(query:str):
         tag_groups.append(current_group)
     return tag_groups
 
-def filter_pride_tags():
-    ORIENTATION_WORDS = ["bisexual", "gay", "futa", "intersex", "lesbian", "transgender", "solo male"]
-    pride_tags = []
-    for orientation in ORIENTATION_WORDS:
-        pride_tags.append({"not": True, "tags": [orientation], "count": 1})
-    return pride_tags
+def random_search(tags_groups, limit, connection):
+    with metrics.stage("get_media_by_tags"):
+        return medialib_db.files_by_tag_search.get_media_by_tags(
+            *tags_groups,
+            limit=limit,
+            offset=0,
+            order_by=medialib_db.files_by_tag_search.ORDERING_BY.RANDOM,
+            filter_hidden=medialib_db.files_by_tag_search.HIDDEN_FILTERING.FILTER,
+            connection=connection
+        )
 
-def filter_bad_tags():
-    bad_tags = []
-    for bad_word in secrets.bad_words:
-        bad_tags.append({"not": True, "tags": [bad_word], "count": 1})
-    return bad_tags
+async def pick_random_content(context, rating_key, tags_groups, connection, count=1):
+    return await get_candidate_pool(context).pick(
+        (rating_key, normalize_tags_groups(tags_groups)),
+        functools.partial(random_search, tags_groups),
+        connection,
+        count
+    )
 
 ORIGIN_URL_TEMPLATE = {
     "derpibooru": "https://derpibooru.org/images/{}",
@@ -112,8 +246,7 @@ ORIGIN_URL_TEMPLATE = {
     "furaffinity": "https://www.furaffinity.net/view/{}/"
 }
 
-def get_image(context, update, raw_content_list, medialib_connection, post_id):
-    content_id = raw_content_list[0][0]
+def get_content_info(context, content_id, medialib_connection):
     content_metadata = medialib_db.get_content_metadata_by_content_id(content_id, medialib_connection)
 
     text_response = []
@@ -129,17 +262,21 @@ def get_image(context, update, raw_content_list, medialib_connection, post_id):
             "Source: {}".format(ORIGIN_URL_TEMPLATE[content_metadata[6]].format(content_metadata[7]))
         )
     file_path = medialib_db.config.relative_to.joinpath(content_metadata[1])
-    image_file = None
+    fingerprint = file_id_cache.file_fingerprint(file_path)
+    cached_file_id = get_file_id_cache(context).get(content_id, file_id_cache.PHOTO, fingerprint)
+    metrics.count_cache("file_id", cached_file_id is not None)
 
     if file_path.suffix == ".srs":
         representations = medialib_db.get_representation_by_content_id(content_id, medialib_connection)
         if len(representations) == 0:
             logging.debug("register representations for content id = {}".format(content_id))
-            cursor = medialib_connection.cursor()
-            medialib_db.srs_indexer.srs_update_representations(content_id, file_path, cursor)
-            medialib_connection.commit()
-            cursor.close()
+            with metrics.stage("srs_index"):
+                cursor = medialib_connection.cursor()
+                medialib_db.srs_indexer.srs_update_representations(content_id, file_path, cursor)
+                medialib_connection.commit()
+                cursor.close()
             representations = medialib_db.get_representation_by_content_id(content_id, medialib_connection)
+        file_path = None
         if len(representations):
             text_response.append("Representations:")
             for representation in representations:
@@ -147,310 +284,451 @@ def get_image(context, update, raw_content_list, medialib_connection, post_id):
                     "level {} — {}".format(representation.compatibility_level, representation.format)
                 )
             if representations[-1].format == "webp":
-                image_file = representations[-1].file_path
-            else:
-                file_path = representations[0].file_path
-    elif file_path.suffix == ".webp":
-        image_file = file_path
-    elif file_path.suffix in {".jpeg", ".jpg"}:
-        if pyimglib.decoders.jpeg.is_JPEG(file_path):
-            jpeg = pyimglib.decoders.jpeg.JPEGDecoder(file_path)
-            arithmetic = False
-            try:
-                if jpeg.arithmetic_coding():
-                    arithmetic = True
-            except ValueError:
-                arithmetic = True
-            if arithmetic:
-                img = pyimglib.decoders.open_image(file_path)
-                print(img)
-                img.thumbnail((1024, 1024))
-                print(img)
-                buffer = io.BytesIO()
-                img.save(buffer, "WEBP", quality=90, method=4)
-                image_file = buffer.getvalue()
-            else:
-                image_file = file_path
-    elif file_path.suffix in {".avif",}:
-        image_file = None
-    else:
-        img = pyimglib.decoders.open_image(file_path)
-        if isinstance(img, pyimglib.decoders.frames_stream.FramesStream):
-            _img = img.next_frame()
-            img.close()
-            img = _img
-        print(img)
-        img.thumbnail((1024, 1024))
-        print(img)
-        buffer = io.BytesIO()
-        img.save(buffer, "WEBP", quality=90, method=4)
-        image_file = buffer.getvalue()
-    if type(image_file) is bytes and len(image_file) == 0:
-        image_file = None
+                file_path = representations[-1].file_path
 
-    text_response.append("Post ID: {}".format(post_id))
+    return file_path, fingerprint, cached_file_id, text_response
 
-    return image_file, text_response
+def get_contents_info(context, content_ids, medialib_connection):
+    return [get_content_info(context, content_id, medialib_connection) for content_id in content_ids]
 
-async def safe(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    medialib_connection = medialib_db.common.make_connection()
-    user_data = get_user_data(update, medialib_connection)
-    permission_level = get_permission_level(update, medialib_connection, user_data)
-    if permission_level == medialib_db.ACCESS_LEVEL.BAN:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text="you are not allowed to do this request")
-        medialib_connection.close()
-        return
+async def make_temporary_preview(context, file_path):
+    # Without the preview cache the worker writes the preview to a temporary file, which is
+    # streamed from disk as well. The file is unlinked right away and goes with its handle.
+    fd, preview_path = await asyncio.to_thread(tempfile.mkstemp, suffix=".webp")
+    os.close(fd)
+    try:
+        preview_size = await get_transcoder(context).make_preview(file_path, pathlib.Path(preview_path))
+        if preview_size == 0:
+            return None
+        return await asyncio.to_thread(open, preview_path, "rb")
+    finally:
+        os.unlink(preview_path)
 
-    tags_groups = [{"not": False, "tags": ["safe"], "count": 1}]
-    query_string = get_query_from_text(update.message.text)
-    tags_groups.extend(query_parser(query_string))
-    print("tags_groups", tags_groups)
+async def make_preview(context, content_id, file_path):
+    preview_cache = get_preview_cache(context)
+    if preview_cache is None:
+        return await make_temporary_preview(context, file_path)
+    fingerprint = file_id_cache.file_fingerprint(file_path)
+    cached_preview = await asyncio.to_thread(preview_cache.get, content_id, fingerprint)
+    metrics.count_cache("preview", cached_preview is not None)
+    if cached_preview is not None:
+        return cached_preview
+    if fingerprint is None:
+        return await make_temporary_preview(context, file_path)
+    # The worker writes the preview into the cache itself, the encoded image is then streamed
+    # from disk instead of being copied back to this process.
+    preview_path = preview_cache.path_for(content_id, fingerprint)
+    preview_size = await get_transcoder(context).make_preview(file_path, preview_path)
+    if preview_size == 0:
+        return None
+    await asyncio.to_thread(preview_cache.account, preview_size)
+    return preview_path
 
-    try:
-        raw_content_list = medialib_db.files_by_tag_search.get_media_by_tags(
-            *tags_groups,
-            limit=1,
-            offset=0,
-            order_by=medialib_db.files_by_tag_search.ORDERING_BY.RANDOM,
-            filter_hidden=medialib_db.files_by_tag_search.HIDDEN_FILTERING.FILTER
-        )
-    except IndexError:
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id, text="not found any images by your query"
-        )
-    if len(raw_content_list) == 0:
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id, text="not found any images by your query"
-        )
-    post_id = medialib_db.register_post(user_data.id, raw_content_list[0][0], medialib_connection)
-    image_file, text_response = get_image(context, update, raw_content_list, medialib_connection, post_id)
+async def get_image(context, content_id, file_path, cached_file_id):
+    if cached_file_id is not None:
+        return cached_file_id
+    if file_path is None:
+        return None
 
-    medialib_connection.close()
+    image_file = None
+    try:
+        if file_path.suffix == ".webp":
+            image_file = file_path
+        elif file_path.suffix in {".jpeg", ".jpg"}:
+            with metrics.stage("jpeg_probe"):
+                coding = await asyncio.to_thread(get_jpeg_probe_cache(context).probe, content_id, file_path)
+            if coding == jpeg_probe.ARITHMETIC:
+                image_file = await make_preview(context, content_id, file_path)
+            elif coding == jpeg_probe.HUFFMAN:
+                image_file = file_path
+        elif file_path.suffix in {".avif",}:
+            image_file = None
+        else:
+            image_file = await make_preview(context, content_id, file_path)
+    except TranscoderBusy:
+        metrics.ERRORS.inc(type="TranscoderBusy")
+        logging.warning("transcoder queue is full, skip preview of {}".format(file_path))
+        image_file = None
+    except TranscoderCrashed:
+        metrics.ERRORS.inc(type="TranscoderCrashed")
+        logging.warning("transcoder worker died on {}, sent without preview".format(file_path))
+        image_file = None
+    except PreviewTooLarge as e:
+        metrics.ERRORS.inc(type="PreviewTooLarge")
+        logging.warning("preview memory budget exceeded: {}".format(e))
+        image_file = None
+    except Exception as e:
+        # a file that fails to decode is sent as text only instead of failing the whole album
+        metrics.ERRORS.inc(type=type(e).__name__)
+        logging.exception("failed to make a preview of {}".format(file_path))
+        image_file = None
+    if type(image_file) is bytes and len(image_file) == 0:
+        image_file = None
+    return image_file
 
+async def send_content_photo(update, context, content_id, fingerprint, image_file, text_response, has_spoiler=False):
     if image_file is not None:
         try:
-            await context.bot.send_photo(
-                chat_id=update.effective_chat.id, photo=image_file, caption="\n".join(text_response)
-            )
+            with metrics.stage("send_photo"):
+                sender = get_message_sender(context)
+                await sender.wait(update.effective_chat.id, is_group_chat(update))
+                async with get_uploader(context).open(image_file) as photo:
+                    message = await sender.send(
+                        context.bot.send_photo,
+                        update.effective_chat.id,
+                        is_group_chat(update),
+                        count=0,
+                        photo=photo,
+                        caption="\n".join(text_response),
+                        has_spoiler=has_spoiler
+                    )
         except telegram.error.BadRequest:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text="\n".join(text_response))
+            if type(image_file) is str:
+                get_file_id_cache(context).invalidate(content_id, file_id_cache.PHOTO)
+            await send_text(update, context, "\n".join(text_response))
+            return
+        if type(image_file) is not str and len(message.photo):
+            get_file_id_cache(context).put(content_id, file_id_cache.PHOTO, fingerprint, message.photo[-1].file_id)
     else:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text="\n".join(text_response))
-
+        await send_text(update, context, "\n".join(text_response))
 
-async def suggestive(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    medialib_connection = medialib_db.common.make_connection()
-    user_data = get_user_data(update, medialib_connection)
-    permission_level = get_permission_level(update, medialib_connection, user_data)
-    if permission_level < medialib_db.ACCESS_LEVEL.SUGGESTIVE:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=UNKNOWN_COMMAND_TEXT_RESPONSE)
-        medialib_connection.close()
+async def send_content_album(update, context, contents, has_spoiler=False):
+    # contents are (content id, fingerprint, image file, text response) tuples. The ones with
+    # an image go out as one media group, the rest as text messages.
+    photos = [content for content in contents if content[2] is not None]
+    if len(photos) < telegram.constants.MediaGroupLimit.MIN_MEDIA_LENGTH:
+        for content in contents:
+            await send_content_photo(update, context, *content, has_spoiler=has_spoiler)
         return
-
-    tags_groups = [{"not": False, "tags": ["suggestive"], "count": 1}]
-    tags_groups.extend(filter_bad_tags())
-    if permission_level >= medialib_db.ACCESS_LEVEL.GAY:
-        tags_groups.extend(filter_pride_tags())
-    query_string = get_query_from_text(update.message.text)
-    tags_groups.extend(query_parser(query_string))
-    print("tags_groups", tags_groups)
-
     try:
-        raw_content_list = medialib_db.files_by_tag_search.get_media_by_tags(
-            *tags_groups,
-            limit=1,
-            offset=0,
-            order_by=medialib_db.files_by_tag_search.ORDERING_BY.RANDOM,
-            filter_hidden=medialib_db.files_by_tag_search.HIDDEN_FILTERING.FILTER
-        )
-    except IndexError:
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id, text="not found any images by your query"
-        )
-    if len(raw_content_list) == 0:
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id, text="not found any images by your query"
+        with metrics.stage("send_photo"):
+            sender = get_message_sender(context)
+            await sender.wait(update.effective_chat.id, is_group_chat(update), len(photos))
+            async with get_uploader(context).open_group([content[2] for content in photos]) as files:
+                messages = await sender.send(
+                    context.bot.send_media_group,
+                    update.effective_chat.id,
+                    is_group_chat(update),
+                    count=0,
+                    media=[
+                        InputMediaPhoto(media=file, caption="\n".join(content[3]), has_spoiler=has_spoiler)
+                        for file, content in zip(files, photos)
+                    ]
+                )
+    except telegram.error.BadRequest:
+        for content_id, fingerprint, image_file, text_response in photos:
+            if type(image_file) is str:
+                get_file_id_cache(context).invalidate(content_id, file_id_cache.PHOTO)
+        # up to ten captions, split into messages within the text length limit
+        lines = []
+        for content in photos:
+            if len(lines):
+                lines.append("")
+            lines.extend(content[3])
+        await get_message_sender(context).send_lines(
+            context.bot, update.effective_chat.id, lines, is_group_chat(update)
         )
-
-    post_id = medialib_db.register_post(user_data.id, raw_content_list[0][0], medialib_connection)
-    image_file, text_response = get_image(context, update, raw_content_list, medialib_connection, post_id)
-
-    medialib_connection.close()
-
-    if image_file is not None:
-        try:
-            spoilered = True
-            if update.effective_chat.type == telegram.constants.ChatType.PRIVATE:
-                spoilered = False
-            await context.bot.send_photo(
-                chat_id=update.effective_chat.id,
-                photo=image_file,
-                caption="\n".join(text_response),
-                has_spoiler=spoilered
-            )
-        except telegram.error.BadRequest:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text="\n".join(text_response))
     else:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text="\n".join(text_response))
+        for message, (content_id, fingerprint, image_file, text_response) in zip(messages, photos):
+            if type(image_file) is not str and len(message.photo):
+                get_file_id_cache(context).put(content_id, file_id_cache.PHOTO, fingerprint, message.photo[-1].file_id)
+    for content in contents:
+        if content[2] is None:
+            await send_text(update, context, "\n".join(content[3]))
 
-
-async def nsfw(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    medialib_connection = medialib_db.common.make_connection()
-    user_data = get_user_data(update, medialib_connection)
-    permission_level = get_permission_level(update, medialib_connection, user_data)
-    if permission_level < medialib_db.ACCESS_LEVEL.NSFW:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=UNKNOWN_COMMAND_TEXT_RESPONSE)
-        medialib_connection.close()
+async def rating_command(update: Update, context: ContextTypes.DEFAULT_TYPE, command: RatingCommand):
+    db = get_db(context)
+    medialib_connection = await acquire_connection(context)
+    try:
+        user_data = await db.run(get_user_data, context, update, medialib_connection)
+        permission_level = await db.run(get_permission_level, context, update, medialib_connection, user_data)
+    except Exception:
+        await release_connection(context, medialib_connection)
+        raise
+    denied_text = command.denied_text(permission_level, UNKNOWN_COMMAND_TEXT_RESPONSE)
+    if denied_text is not None:
+        await send_text(update, context, denied_text)
+        await release_connection(context, medialib_connection)
         return
 
-    tags_groups = [{"not": True, "tags": ["safe"], "count": 1}]
-    tags_groups.extend(filter_bad_tags())
-    if permission_level >= medialib_db.ACCESS_LEVEL.GAY:
-        tags_groups.extend(filter_pride_tags())
-    query_string = get_query_from_text(update.message.text)
-    tags_groups.extend(query_parser(query_string))
-    print("tags_groups", tags_groups)
-
+    count, query_string = split_count(get_query_from_text(update.message.text))
     try:
-        raw_content_list = medialib_db.files_by_tag_search.get_media_by_tags(
-            *tags_groups,
-            limit=1,
-            offset=0,
-            order_by=medialib_db.files_by_tag_search.ORDERING_BY.RANDOM,
-            filter_hidden=medialib_db.files_by_tag_search.HIDDEN_FILTERING.FILTER
-        )
-    except IndexError:
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id, text="not found any images by your query"
+        query_groups, unknown_tags = await db.run(
+            get_tag_resolver(context).resolve_groups, query_parser(query_string), medialib_connection
         )
-    if len(raw_content_list) == 0:
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id, text="not found any images by your query"
+    except Exception:
+        await release_connection(context, medialib_connection)
+        raise
+    if len(unknown_tags):
+        await release_connection(context, medialib_connection)
+        await send_text(
+            update, context, "not found any images by your query, unknown tags: {}".format(", ".join(unknown_tags))
         )
+        return
+    tags_groups = command.tags_groups(get_rating_filters(context), permission_level)
+    tags_groups.extend(query_groups)
+    logging.debug("tags_groups {}".format(tags_groups))
 
-    post_id = medialib_db.register_post(user_data.id, raw_content_list[0][0], medialib_connection)
-    image_file, text_response = get_image(context, update, raw_content_list, medialib_connection, post_id)
-
-    medialib_connection.close()
+    try:
+        with metrics.stage("search"):
+            raw_content_list = await pick_random_content(
+                context,
+                (command.name, command.filter_pride(permission_level)),
+                tags_groups,
+                medialib_connection,
+                count
+            )
+    except IndexError:
+        raw_content_list = []
+    except Exception:
+        await release_connection(context, medialib_connection)
+        raise
+    if len(raw_content_list) == 0:
+        await release_connection(context, medialib_connection)
+        await send_text(update, context, "not found any images by your query")
+        return
 
-    if image_file is not None:
-        try:
-            spoilered = True
-            if update.effective_chat.type == telegram.constants.ChatType.PRIVATE:
-                spoilered = False
-            await context.bot.send_photo(
-                chat_id=update.effective_chat.id,
-                photo=image_file,
-                caption="\n".join(text_response),
-                has_spoiler=spoilered
+    content_ids = [row[0] for row in raw_content_list]
+    try:
+        with metrics.stage("register_post"):
+            post_ids = await get_post_writer(context).register_posts(
+                user_data.id, content_ids, medialib_connection
             )
-        except telegram.error.BadRequest:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text="\n".join(text_response))
-    else:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text="\n".join(text_response))
+        with metrics.stage("content_info"):
+            contents_info = await db.run(get_contents_info, context, content_ids, medialib_connection)
+    finally:
+        await release_connection(context, medialib_connection)
+    # previews of an album are transcoded in parallel
+    with metrics.stage("get_image"):
+        image_files = await asyncio.gather(*(
+            get_image(context, content_id, file_path, cached_file_id)
+            for content_id, (file_path, fingerprint, cached_file_id, text_response) in zip(content_ids, contents_info)
+        ))
+    contents = []
+    for content_id, post_id, image_file, (file_path, fingerprint, cached_file_id, text_response) in zip(
+            content_ids, post_ids, image_files, contents_info
+    ):
+        text_response.append("Post ID: {}".format(post_id))
+        contents.append((content_id, fingerprint, image_file, text_response))
+    if len(contents) > 1:
+        await send_content_album(
+            update, context, contents, has_spoiler=command.has_spoiler(update.effective_chat.type)
+        )
+        return
+
+    content_id, fingerprint, image_file, text_response = contents[0]
+    await send_content_photo(
+        update,
+        context,
+        content_id,
+        fingerprint,
+        image_file,
+        text_response,
+        has_spoiler=command.has_spoiler(update.effective_chat.type)
+    )
 
 
-async def explicit(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    medialib_connection = medialib_db.common.make_connection()
-    user_data = get_user_data(update, medialib_connection)
-    permission_level = get_permission_level(update, medialib_connection, user_data)
-    if permission_level < medialib_db.ACCESS_LEVEL.NSFW:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=UNKNOWN_COMMAND_TEXT_RESPONSE)
-        medialib_connection.close()
+async def tag(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    db = get_db(context)
+    medialib_connection = await acquire_connection(context)
+    try:
+        permission_level = await db.run(get_permission_level, context, update, medialib_connection)
+    finally:
+        await release_connection(context, medialib_connection)
+    if permission_level == medialib_db.ACCESS_LEVEL.BAN:
+        await send_text(update, context, "you are not allowed to do this request")
         return
 
-    tags_groups = [{"not": False, "tags": ["explicit"], "count": 1}]
-    tags_groups.extend(filter_bad_tags())
-    if permission_level >= medialib_db.ACCESS_LEVEL.GAY:
-        tags_groups.extend(filter_pride_tags())
     query_string = get_query_from_text(update.message.text)
-    tags_groups.extend(query_parser(query_string))
-    print("tags_groups", tags_groups)
+    sender = get_message_sender(context)
+    if '*' not in query_string:
+        await sender.send_message(context.bot, update.effective_chat.id, "not implemented", is_group_chat(update))
+        return
+    # Results are fetched and sent page by page, so a broad wildcard never has to be held in memory.
+    page_size = bot_config.TAG_SEARCH_PAGE_SIZE
+    after = None
+    pages = 0
+    while True:
+        page = await call_with_connection(
+            context, tag_search.wildcard_tag_search, query_string, limit=page_size, after=after
+        )
+        if pages == 0 and len(page) == 0:
+            await sender.send_message(context.bot, update.effective_chat.id, "not found", is_group_chat(update))
+            return
+        response_lines = []
+        if pages == 0 and len(page) == page_size:
+            response_lines.append("There are long list. Please, wait until all contents will be send.")
+        for tag_alias_id, tag_alias_title, tag_id, tag_title, tag_category in page:
+            response_lines.append("{} → id{}: {} ({})".format(tag_alias_title, tag_id, tag_title, tag_category))
+        await sender.send_lines(context.bot, update.effective_chat.id, response_lines, is_group_chat(update))
+        pages += 1
+        if len(page) < page_size:
+            break
+        after = tag_search.page_cursor(page)
+    if pages > 1:
+        await sender.send_message(context.bot, update.effective_chat.id, "END", is_group_chat(update))
 
-    try:
-        raw_content_list = medialib_db.files_by_tag_search.get_media_by_tags(
+def parse_inline_query(text: str):
+    # "nsfw tag_a not tag_b": a leading rating command name picks the rating, /safe is used otherwise
+    words = text.strip().split(" ", 1)
+    for command in RATING_COMMANDS:
+        if command.name == words[0]:
+            return command, words[1] if len(words) == 2 else ''
+    return RATING_COMMANDS[0], text.strip()
+
+def inline_search(tags_groups, offset, limit, connection):
+    with metrics.stage("get_media_by_tags"):
+        return medialib_db.files_by_tag_search.get_media_by_tags(
             *tags_groups,
-            limit=1,
-            offset=0,
-            order_by=medialib_db.files_by_tag_search.ORDERING_BY.RANDOM,
-            filter_hidden=medialib_db.files_by_tag_search.HIDDEN_FILTERING.FILTER
+            limit=limit,
+            offset=offset,
+            order_by=medialib_db.files_by_tag_search.ORDERING_BY.DATE_DECREASING,
+            filter_hidden=medialib_db.files_by_tag_search.HIDDEN_FILTERING.FILTER,
+            connection=connection
         )
-    except IndexError:
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id, text="not found any images by your query"
-        )
-    if len(raw_content_list) == 0:
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id, text="not found any images by your query"
-        )
-
-    post_id = medialib_db.register_post(user_data.id, raw_content_list[0][0], medialib_connection)
-    image_file, text_response = get_image(context, update, raw_content_list, medialib_connection, post_id)
 
-    medialib_connection.close()
+def get_cached_photos(context, raw_content_list) -> list:
+    # (content id, file_id) of the found contents that were sent as photos before, in search order
+    fingerprints = {
+        row[0]: file_id_cache.file_fingerprint(medialib_db.config.relative_to.joinpath(row[1]))
+        for row in raw_content_list
+    }
+    file_ids = get_file_id_cache(context).get_many(fingerprints, file_id_cache.PHOTO)
+    for content_id in fingerprints:
+        metrics.count_cache("file_id", content_id in file_ids)
+    return [(row[0], file_ids[row[0]]) for row in raw_content_list if row[0] in file_ids]
 
-    if image_file is not None:
-        try:
-            spoilered = True
-            if update.effective_chat.type == telegram.constants.ChatType.PRIVATE:
-                spoilered = False
-            await context.bot.send_photo(
-                chat_id=update.effective_chat.id,
-                photo=image_file,
-                caption="\n".join(text_response),
-                has_spoiler=spoilered
-            )
-        except telegram.error.BadRequest:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text="\n".join(text_response))
-    else:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text="\n".join(text_response))
+def find_cached_photos(context, tags_groups, offset, connection):
+    # Reads search pages from offset on, each twice as large as the one before, until a page
+    # worth of cached photos is found, the search runs out or inline_max_scanned rows were read.
+    # Returns the photos, the offset to continue from and whether the search ran out.
+    cached_photos = []
+    position = offset
+    limit = bot_config.INLINE_PAGE_SIZE
+    while len(cached_photos) < bot_config.INLINE_PAGE_SIZE and position - offset < bot_config.INLINE_MAX_SCANNED:
+        limit = min(limit, offset + bot_config.INLINE_MAX_SCANNED - position)
+        raw_content_list = inline_search(tags_groups, position, limit, connection)
+        file_ids = dict(get_cached_photos(context, raw_content_list))
+        page_end = position + len(raw_content_list)
+        for row in raw_content_list:
+            position += 1
+            if row[0] in file_ids:
+                cached_photos.append((row[0], file_ids[row[0]]))
+                if len(cached_photos) == bot_config.INLINE_PAGE_SIZE:
+                    break
+        if len(raw_content_list) < limit and position == page_end:
+            return cached_photos, position, True
+        limit *= 2
+    return cached_photos, position, False
 
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Up to a page of the newest matching contents per query. Only contents with a stored
+    # file_id are offered, so answering needs no upload. A search page without any of them
+    # does not end the results, the search goes on past it.
+    query = update.inline_query
+    command, query_string = parse_inline_query(query.query)
+    try:
+        offset = int(query.offset or 0)
+    except ValueError:
+        offset = 0
+    # the chat the result will be sent to; cached photo results can't be marked as a spoiler
+    chat_type = query.chat_type
+    if chat_type == telegram.constants.ChatType.SENDER:
+        chat_type = telegram.constants.ChatType.PRIVATE
 
-async def tag(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    medialib_connection = medialib_db.common.make_connection()
-    user_data = get_user_data(update, medialib_connection)
-    permission_level = get_permission_level(update, medialib_connection, user_data)
-    if permission_level == medialib_db.ACCESS_LEVEL.BAN:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text="you are not allowed to do this request")
-        medialib_connection.close()
+    db = get_db(context)
+    medialib_connection = await acquire_connection(context)
+    try:
+        user_data = await db.run(get_user_data, context, update, medialib_connection)
+        query_groups, unknown_tags = await db.run(
+            get_tag_resolver(context).resolve_groups, query_parser(query_string), medialib_connection
+        )
+    finally:
+        await release_connection(context, medialib_connection)
+    permission_level = user_data.access_level
+    if command.denied_text(permission_level, UNKNOWN_COMMAND_TEXT_RESPONSE) is not None \
+            or command.has_spoiler(chat_type) or len(unknown_tags):
+        await query.answer([], cache_time=bot_config.INLINE_CACHE_TIME, is_personal=True)
         return
+    tags_groups = command.tags_groups(get_rating_filters(context), permission_level)
+    tags_groups.extend(query_groups)
 
-    query_string = get_query_from_text(update.message.text)
-    response_lines = []
-    if '*' in query_string:
-        tag_aliases = medialib_db.tags_indexer.wildcard_tag_search(query_string, medialib_connection)
-        for tag_alias in tag_aliases:
-            tag_info = medialib_db.tags_indexer.get_tag_info_by_tag_id(tag_alias[0], medialib_connection)
-            response_lines.append(
-                "{} → id{}: {} ({})".format(tag_alias[1], tag_info[0], tag_info[1], tag_info[2])
-            )
-        if len(tag_aliases) == 0:
-            response_lines.append("not found")
-    else:
-        response_lines.append("not implemented")
-    medialib_connection.close()
-    i = 0
-    while i < len(response_lines):
-        send_response = response_lines[i:(i + 10)]
-        if i == 0 and len(response_lines) > 10:
-            send_response.insert(0, "There are long list. Please, wait until all contents will be send.")
-        if len(send_response) > 0:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id, text="\n".join(send_response)
-            )
-        time.sleep(2)
-        i += 10
-    if len(response_lines) > 10:
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id, text="END"
+    with metrics.stage("search"):
+        cached_photos, position, exhausted = await call_with_connection(
+            context, find_cached_photos, context, tags_groups, offset
         )
+    next_offset = ""
+    if not exhausted and len(cached_photos):
+        next_offset = str(position)
+    await query.answer(
+        [
+            InlineQueryResultCachedPhoto(id=str(content_id), photo_file_id=file_id)
+            for content_id, file_id in cached_photos
+        ],
+        cache_time=bot_config.INLINE_CACHE_TIME,
+        is_personal=True,
+        next_offset=next_offset
+    )
 
 class UPLOAD_TYPE(enum.Enum):
     BEST = enum.auto()
     WEBP = enum.auto()
+    ANIMATION = enum.auto()
+
+async def send_animated_preview(update, context, content_id, file_path, fingerprint, cached_file_id):
+    kind = UPLOAD_TYPE.ANIMATION.name.lower()
+    if cached_file_id is not None:
+        try:
+            with metrics.stage("send_animation"):
+                await get_message_sender(context).send(
+                    context.bot.send_animation,
+                    update.effective_chat.id,
+                    is_group_chat(update),
+                    animation=cached_file_id
+                )
+            return
+        except telegram.error.BadRequest:
+            get_file_id_cache(context).invalidate(content_id, kind)
+    animation = b""
+    if file_path is not None and file_path.suffix.lower() in ANIMATED_FORMATS:
+        try:
+            animation = await get_transcoder(context).make_animated_preview(file_path)
+        except (TranscoderBusy, TranscoderCrashed) as e:
+            metrics.ERRORS.inc(type=type(e).__name__)
+            await send_text(update, context, "Busy. Please, try again later.")
+            return
+        except PreviewTooLarge as e:
+            metrics.ERRORS.inc(type="PreviewTooLarge")
+            logging.warning("preview memory budget exceeded: {}".format(e))
+            await send_text(update, context, "Animation is too large.")
+            return
+    if len(animation) == 0:
+        await send_text(update, context, "That post is not animated.")
+        return
+    sender = get_message_sender(context)
+    with metrics.stage("send_animation"):
+        await sender.wait(update.effective_chat.id, is_group_chat(update))
+        async with get_uploader(context).open(animation) as file:
+            message = await sender.send(
+                context.bot.send_animation,
+                update.effective_chat.id,
+                is_group_chat(update),
+                count=0,
+                animation=file,
+                filename="preview.gif"
+            )
+    if message.animation is not None:
+        get_file_id_cache(context).put(content_id, kind, fingerprint, message.animation.file_id)
+    elif message.document is not None:
+        get_file_id_cache(context).put(content_id, kind, fingerprint, message.document.file_id)
+
+async def find_post(context, post_id, connection):
+    post_data = get_post_writer(context).get_pending(post_id)
+    if post_data is None:
+        post_data = await get_db(context).run(medialib_db.get_post, post_id, connection)
+    return post_data
 
 async def file_uploader(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    print("BEST HANDLER")
     query = update.message.text.split(" ", 1)
     query_string = ''
     if len(query) == 2:
@@ -461,101 +739,320 @@ async def file_uploader(update: Update, context: ContextTypes.DEFAULT_TYPE):
         mode = UPLOAD_TYPE.BEST
     elif "webp" in query[0]:
         mode = UPLOAD_TYPE.WEBP
+    elif "animation" in query[0]:
+        mode = UPLOAD_TYPE.ANIMATION
     else:
         raise NotImplemented(query[0])
     try:
         post_id = int(query_string)
     except:
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id, text="Invalid Post ID."
-        )
+        await send_text(update, context, "Invalid Post ID.")
         return
-    medialib_connection = medialib_db.common.make_connection()
-    user_data = get_user_data(update, medialib_connection)
+    db = get_db(context)
+    medialib_connection = await acquire_connection(context)
+    try:
+        user_data = await db.run(get_user_data, context, update, medialib_connection)
+    except Exception:
+        await release_connection(context, medialib_connection)
+        raise
     if user_data.access_level == medialib_db.ACCESS_LEVEL.BAN:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text="you are not allowed to do this request")
-        medialib_connection.close()
-        return
-    post_data = medialib_db.get_post(post_id, medialib_connection)
-    if post_data is None:
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id, text="Post not found."
-        )
-        medialib_connection.close()
+        await send_text(update, context, "you are not allowed to do this request")
+        await release_connection(context, medialib_connection)
         return
-    if post_data[1] != user_data.id:
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id, text="That post is not yours."
+    try:
+        post_data = await find_post(context, post_id, medialib_connection)
+        if post_data is None and bot_config.POST_WRITE_BEHIND and bot_config.SHARDS > 1:
+            # a post registered by another worker is in the database after that worker's next flush
+            await release_connection(context, medialib_connection)
+            medialib_connection = None
+            await asyncio.sleep(bot_config.POST_FLUSH_INTERVAL)
+            medialib_connection = await acquire_connection(context)
+            post_data = await find_post(context, post_id, medialib_connection)
+        if post_data is None:
+            await send_text(update, context, "Post not found.")
+            return
+        if post_data[1] != user_data.id:
+            await send_text(update, context, "That post is not yours.")
+            return
+
+        content_id = post_data[2]
+        content_metadata = await db.run(
+            medialib_db.get_content_metadata_by_content_id, content_id, medialib_connection
         )
-        medialib_connection.close()
-        return
 
-    content_id = post_data[2]
-    content_metadata = medialib_db.get_content_metadata_by_content_id(content_id, medialib_connection)
+        file_path = medialib_db.config.relative_to.joinpath(content_metadata[1])
+        fingerprint = file_id_cache.file_fingerprint(file_path)
+        cached_file_id = get_file_id_cache(context).get(content_id, mode.name.lower(), fingerprint)
+        metrics.count_cache("file_id", cached_file_id is not None)
 
-    file_path = medialib_db.config.relative_to.joinpath(content_metadata[1])
+        if file_path.suffix == ".srs":
+            representations = await db.run(
+                medialib_db.get_representation_by_content_id, content_id, medialib_connection
+            )
+            if len(representations):
+                if mode == UPLOAD_TYPE.BEST:
+                    file_path = representations[0].file_path
+                elif mode in {UPLOAD_TYPE.WEBP, UPLOAD_TYPE.ANIMATION}:
+                    webp_source = None
+                    for representation in representations:
+                        if representation.format == "webp":
+                            webp_source = representation.file_path
+                    file_path = webp_source
+        elif mode == UPLOAD_TYPE.WEBP:
+            if file_path.suffix != ".webp":
+                file_path = None
+    finally:
+        if medialib_connection is not None:
+            await release_connection(context, medialib_connection)
 
-    if file_path.suffix == ".srs":
-        representations = medialib_db.get_representation_by_content_id(content_id, medialib_connection)
-        if len(representations):
-            if mode == UPLOAD_TYPE.BEST:
-                file_path = representations[0].file_path
-            elif mode == UPLOAD_TYPE.WEBP:
-                webp_source = None
-                for representation in representations:
-                    if representation.format == "webp":
-                        webp_source = representation.file_path
-                file_path = webp_source
-    elif mode == UPLOAD_TYPE.WEBP:
-        if file_path.suffix != ".webp":
-            file_path = None
-    medialib_connection.close()
+    if mode == UPLOAD_TYPE.ANIMATION:
+        await send_animated_preview(update, context, content_id, file_path, fingerprint, cached_file_id)
+        return
+    if cached_file_id is not None:
+        try:
+            with metrics.stage("send_document"):
+                await get_message_sender(context).send(
+                    context.bot.send_document,
+                    update.effective_chat.id,
+                    is_group_chat(update),
+                    document=cached_file_id
+                )
+            return
+        except telegram.error.BadRequest:
+            get_file_id_cache(context).invalidate(content_id, mode.name.lower())
 
     if file_path is not None:
         if file_path.suffix == ".mpd":
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id, text="Sorry. Cannot post this file."
-            )
+            await send_text(update, context, "Sorry. Cannot post this file.")
             return
 
-        await context.bot.send_document(
-            chat_id=update.effective_chat.id, document=file_path
+        sender = get_message_sender(context)
+        with metrics.stage("send_document"):
+            await sender.wait(update.effective_chat.id, is_group_chat(update))
+            async with get_uploader(context).open(file_path) as document:
+                message = await sender.send(
+                    context.bot.send_document,
+                    update.effective_chat.id,
+                    is_group_chat(update),
+                    count=0,
+                    document=document
+                )
+        if message.document is not None:
+            get_file_id_cache(context).put(content_id, mode.name.lower(), fingerprint, message.document.file_id)
+    else:
+        await send_text(update, context, "File not found.")
+
+
+async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await send_text(update, context, UNKNOWN_COMMAND_TEXT_RESPONSE)
+
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    metrics.ERRORS.inc(type=type(context.error).__name__)
+    if isinstance(context.error, (DBCallTimeout, PoolTimeout)):
+        logging.warning("medialib_db call timed out: {}".format(context.error))
+        if isinstance(update, Update) and update.effective_chat is not None:
+            await send_text(update, context, "Server is busy. Please, try again later.")
+    else:
+        logging.error("Exception while handling an update:", exc_info=context.error)
+
+
+async def post_init(application):
+    db = DBExecutor(
+        bot_config.DB_WORKERS, bot_config.DB_MAX_CONCURRENCY, bot_config.DB_CALL_TIMEOUT
+    )
+    pool = ConnectionPool(
+        medialib_db.common.make_connection,
+        min_size=bot_config.DB_POOL_MIN_SIZE,
+        max_size=bot_config.DB_POOL_MAX_SIZE,
+        max_idle_time=bot_config.DB_POOL_MAX_IDLE_TIME,
+        checkout_timeout=bot_config.DB_CALL_TIMEOUT,
+        health_check_after=bot_config.DB_POOL_HEALTH_CHECK_AFTER
+    )
+    application.bot_data[DB_EXECUTOR_KEY] = db
+    application.bot_data[DB_POOL_KEY] = pool
+    connections = AsyncConnectionPool(pool, db)
+    application.bot_data[DB_CONNECTIONS_KEY] = connections
+    application.bot_data[FILE_ID_CACHE_KEY] = file_id_cache.FileIDCache(bot_config.FILE_ID_CACHE_PATH)
+    application.bot_data[JPEG_PROBE_CACHE_KEY] = jpeg_probe.JPEGProbeCache(bot_config.FILE_ID_CACHE_PATH)
+    application.bot_data[USER_CACHE_KEY] = TTLCache(bot_config.ACCESS_CACHE_SIZE, bot_config.ACCESS_CACHE_TTL)
+    application.bot_data[CHAT_CACHE_KEY] = TTLCache(bot_config.ACCESS_CACHE_SIZE, bot_config.ACCESS_CACHE_TTL)
+    application.bot_data[CANDIDATE_POOL_KEY] = CandidatePool(
+        db,
+        connections,
+        bot_config.CANDIDATE_BATCH_SIZE,
+        bot_config.CANDIDATE_LOW_WATERMARK,
+        bot_config.CANDIDATE_TTL,
+        bot_config.CANDIDATE_POOL_MAX_QUERIES
+    )
+    application.bot_data[MESSAGE_SENDER_KEY] = MessageSender(
+        bot_config.GLOBAL_MESSAGE_RATE,
+        bot_config.PRIVATE_CHAT_MESSAGE_RATE,
+        bot_config.GROUP_CHAT_MESSAGE_RATE,
+        bot_config.CHAT_MESSAGE_BURST
+    )
+    application.bot_data[UPLOADER_KEY] = Uploader(bot_config.MAX_CONCURRENT_UPLOADS)
+    application.bot_data[TRANSCODER_KEY] = Transcoder(
+        bot_config.TRANSCODER_WORKERS,
+        bot_config.TRANSCODER_QUEUE_DEPTH,
+        bot_config.PREVIEW_MEMORY_BUDGET,
+        bot_config.ANIMATED_PREVIEW_MAX_FRAMES,
+        bot_config.ANIMATED_PREVIEW_MEMORY_BUDGET
+    )
+    if bot_config.PREVIEW_CACHE_DIR is not None:
+        application.bot_data[PREVIEW_CACHE_KEY] = await asyncio.to_thread(
+            PreviewCache, bot_config.PREVIEW_CACHE_DIR, bot_config.PREVIEW_CACHE_MAX_SIZE
+        )
+    await db.run(pool.fill)
+    tag_resolver = TagResolver(
+        connections,
+        bot_config.TAG_RESOLVER_REFRESH_INTERVAL,
+        bot_config.TAG_RESOLVER_RELOAD_INTERVAL,
+        bot_config.UNKNOWN_TAG_TTL,
+        bot_config.UNKNOWN_TAG_CACHE_SIZE
+    )
+    rating_filters = RatingFilters(RATING_COMMANDS, tag_resolver)
+    tag_resolver.add_listener(rating_filters.resolve)
+    await connections.call(tag_resolver.load)
+    tag_resolver.start()
+    application.bot_data[TAG_RESOLVER_KEY] = tag_resolver
+    application.bot_data[RATING_FILTERS_KEY] = rating_filters
+    if bot_config.POST_WRITE_BEHIND:
+        post_writer = PostWriter(
+            db,
+            connections,
+            bot_config.POST_TABLE,
+            bot_config.POST_ID_SEQUENCE,
+            bot_config.POST_ID_BLOCK_SIZE,
+            bot_config.POST_FLUSH_INTERVAL,
+            bot_config.POST_FLUSH_MAX_BATCH,
+            bot_config.POST_MAX_PENDING,
+            bot_config.POST_FLUSH_MAX_ATTEMPTS
         )
     else:
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id, text="File not found."
+        post_writer = DirectPostWriter(db)
+    post_writer.start()
+    application.bot_data[POST_WRITER_KEY] = post_writer
+    application.bot_data[METRICS_KEY] = register_metrics(application)
+
+
+def register_metrics(application) -> list:
+    # Counters the pool and the in-memory caches keep themselves, read on every scrape.
+    pool = application.bot_data[DB_POOL_KEY]
+    caches = {
+        "candidates": application.bot_data[CANDIDATE_POOL_KEY],
+        "user": application.bot_data[USER_CACHE_KEY],
+        "chat": application.bot_data[CHAT_CACHE_KEY]
+    }
+
+    def pool_connections():
+        stats = pool.stats()
+        return [((state,), stats[state]) for state in ("idle", "in_use", "waiting")]
+
+    def pool_events():
+        stats = pool.stats()
+        return [((event,), stats[event]) for event in ("created", "discarded")]
+
+    def memory_cache_requests():
+        values = []
+        for name, cache in caches.items():
+            values.append(((name, "hit"), cache.hits))
+            values.append(((name, "miss"), cache.misses))
+        return values
+
+    return [
+        metrics.CallbackMetric(
+            "bot_db_pool_connections", "medialib_db connections by state.", "gauge", ["state"], pool_connections
+        ),
+        metrics.CallbackMetric(
+            "bot_db_pool_events_total", "medialib_db connections opened and discarded.", "counter", ["event"],
+            pool_events
+        ),
+        metrics.CallbackMetric(
+            "bot_memory_cache_requests_total", "Lookups of the in-memory caches by result.", "counter",
+            ["cache", "result"], memory_cache_requests
         )
+    ]
 
 
-async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=UNKNOWN_COMMAND_TEXT_RESPONSE)
+async def post_shutdown(application):
+    for metric in application.bot_data.get(METRICS_KEY, []):
+        metrics.REGISTRY.unregister(metric)
+    application.bot_data[TAG_RESOLVER_KEY].close()
+    await application.bot_data[POST_WRITER_KEY].close()
+    pool = application.bot_data[DB_POOL_KEY]
+    logging.info("medialib_db pool stats: {}".format(pool.stats()))
+    pool.close()
+    application.bot_data[DB_EXECUTOR_KEY].shutdown()
+    application.bot_data[FILE_ID_CACHE_KEY].close()
+    application.bot_data[JPEG_PROBE_CACHE_KEY].close()
+    application.bot_data[TRANSCODER_KEY].shutdown()
 
 
-if __name__ == '__main__':
-    application = ApplicationBuilder().token(secrets.API_key).build()
-
-    start_handler = CommandHandler('start', start)
-    help_handler = CommandHandler('help', start)
-    echo_handler = MessageHandler(filters.TEXT & (~filters.COMMAND), default_answer)
-    safe_handler = CommandHandler('safe', safe)
-    suggestive_handler = CommandHandler('suggestive', suggestive)
-    nsfw_handler = CommandHandler('nsfw', nsfw)
-    explicit_handler = CommandHandler('explicit', explicit)
-    tag_handler = CommandHandler('tag', tag)
-    best_handler = CommandHandler('best', file_uploader)
-    webp_handler = CommandHandler('webp', file_uploader)
-    unknown_handler = MessageHandler(filters.COMMAND, unknown)
+def build_application(updater=True, request=None):
+    # request replaces the HTTP client used for Bot API calls, e.g. by benchmarks/handler_benchmark.py
+    builder = ApplicationBuilder()\
+        .token(secrets.API_key)\
+        .post_init(post_init)\
+        .post_shutdown(post_shutdown)\
+        .concurrent_updates(bot_config.CONCURRENT_UPDATES)
+    if bot_config.TELEGRAM_API_BASE_URL is not None:
+        builder.base_url(bot_config.TELEGRAM_API_BASE_URL)
+    if bot_config.TELEGRAM_API_BASE_FILE_URL is not None:
+        builder.base_file_url(bot_config.TELEGRAM_API_BASE_FILE_URL)
+    if not updater:
+        builder.updater(None)
+    if request is not None:
+        builder.request(request)
+    application = builder.build()
+
+    timed = metrics.timed_handler
+    start_handler = CommandHandler('start', timed('start', start))
+    help_handler = CommandHandler('help', timed('help', start))
+    refresh_handler = CommandHandler('refresh', timed('refresh', refresh))
+    echo_handler = MessageHandler(filters.TEXT & (~filters.COMMAND), timed('echo', default_answer))
+    rating_handlers = [
+        CommandHandler(command.name, timed(command.name, functools.partial(rating_command, command=command)))
+        for command in RATING_COMMANDS
+    ]
+    tag_handler = CommandHandler('tag', timed('tag', tag))
+    inline_handler = InlineQueryHandler(timed('inline', inline_query))
+    best_handler = CommandHandler('best', timed('best', file_uploader))
+    webp_handler = CommandHandler('webp', timed('webp', file_uploader))
+    animation_handler = CommandHandler('animation', timed('animation', file_uploader))
+    unknown_handler = MessageHandler(filters.COMMAND, timed('unknown', unknown))
 
     application.add_handler(start_handler)
     application.add_handler(help_handler)
+    application.add_handler(refresh_handler)
     application.add_handler(echo_handler)
-    application.add_handler(safe_handler)
-    application.add_handler(suggestive_handler)
-    application.add_handler(nsfw_handler)
-    application.add_handler(explicit_handler)
+    application.add_handlers(rating_handlers)
     application.add_handler(tag_handler)
+    application.add_handler(inline_handler)
     application.add_handler(best_handler)
     application.add_handler(webp_handler)
+    application.add_handler(animation_handler)
     application.add_handler(unknown_handler)
+    application.add_error_handler(error_handler)
+    return application
+
+
+if __name__ == '__main__':
+    application = build_application()
+    if bot_config.METRICS_PORT is not None:
+        metrics.start_http_server(bot_config.METRICS_LISTEN, bot_config.METRICS_PORT)
 
-    application.run_polling()
+    # On SIGTERM/SIGINT the updater stops taking new updates first, then the application
+    # finishes the updates already being processed before post_shutdown flushes and closes
+    # the DB pool, so no handler is cut off half way.
+    if bot_config.WEBHOOK_URL is not None:
+        application.run_webhook(
+            listen=bot_config.WEBHOOK_LISTEN,
+            port=bot_config.WEBHOOK_PORT,
+            url_path=bot_config.WEBHOOK_PATH,
+            webhook_url=bot_config.WEBHOOK_URL,
+            secret_token=bot_config.WEBHOOK_SECRET_TOKEN,
+            max_connections=bot_config.WEBHOOK_MAX_CONNECTIONS
+        )
+    else:
+        application.run_polling()
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import time
+
+import telegram.error
+from telegram.constants import MessageLimit
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = MessageLimit.MAX_TEXT_LENGTH
+
+
+def pack_lines(lines, limit: int = MAX_MESSAGE_LENGTH) -> list:
+    messages = []
+    current = []
+    current_length = 0
+    for line in lines:
+        while len(line) > limit:
+            if len(current):
+                messages.append("\n".join(current))
+                current = []
+                current_length = 0
+            messages.append(line[:limit])
+            line = line[limit:]
+        added_length = len(line) + (1 if len(current) else 0)
+        if current_length + added_length > limit:
+            messages.append("\n".join(current))
+            current = []
+            current_length = 0
+            added_length = len(line)
+        current.append(line)
+        current_length += added_length
+    if len(current):
+        messages.append("\n".join(current))
+    return messages
+
+
+class TokenBucket:
+    # Callers reserve a token up front and sleep until it becomes available, so concurrent
+    # senders are served in the order they asked and never exceed the rate.
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self._tokens >= self.capacity
+
+    async def acquire(self, count: int = 1):
+        self._refill()
+        self._tokens -= count
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+
+class MessageSender:
+    # Outbound messages scheduler respecting Telegram flood limits: a global bucket
+    # for the bot and a bucket per chat, with a lower rate for groups and channels.
+    # Every item of a media group counts as a message.
+    MAX_IDLE_CHAT_BUCKETS = 1000
+
+    def __init__(self, global_rate: float, private_chat_rate: float, group_chat_rate: float, burst: int):
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self.private_chat_rate = private_chat_rate
+        self.group_chat_rate = group_chat_rate
+        self.burst = burst
+        self._chat_buckets = {}
+
+    def _chat_bucket(self, chat_id, group: bool) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.MAX_IDLE_CHAT_BUCKETS:
+                for idle_chat_id in [key for key, value in self._chat_buckets.items() if value.is_full()]:
+                    del self._chat_buckets[idle_chat_id]
+            bucket = TokenBucket(self.group_chat_rate if group else self.private_chat_rate, self.burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def wait(self, chat_id, group: bool = False, count: int = 1):
+        # reserves count messages, e.g. before an upload slot is taken, so the slot isn't held
+        # while the chat is throttled
+        if count > 0:
+            await self._chat_bucket(chat_id, group).acquire(count)
+            await self._global_bucket.acquire(count)
+
+    async def send(self, send_method, chat_id, group: bool = False, count: int = 1, **kwargs):
+        # send_method is a Bot method like send_photo; count is 0 if the messages were reserved with wait
+        await self.wait(chat_id, group, count)
+        try:
+            return await send_method(chat_id=chat_id, **kwargs)
+        except telegram.error.RetryAfter as e:
+            logger.warning("flood limit hit in chat {}, retry after {} s".format(chat_id, e.retry_after))
+            await asyncio.sleep(e.retry_after)
+            return await send_method(chat_id=chat_id, **kwargs)
+
+    async def send_message(self, bot, chat_id, text: str, group: bool = False, **kwargs):
+        return await self.send(bot.send_message, chat_id, group, text=text, **kwargs)
+
+    async def send_lines(self, bot, chat_id, lines, group: bool = False, **kwargs):
+        messages = []
+        for text in pack_lines(lines):
+            messages.append(await self.send_message(bot, chat_id, text, group, **kwargs))
+        return messages
@@ -0,0 +1,233 @@
+import contextlib
+import contextvars
+import functools
+import http.server
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+request_logger = logging.getLogger("bot.requests")
+
+# upper bounds in seconds, from a cached file_id send to a slow SRS indexing
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(labelnames, labelvalues, extra="") -> str:
+    pairs = [
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in zip(labelnames, labelvalues)
+    ]
+    if extra:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def unregister(self, metric):
+        with self._lock:
+            self._metrics.remove(metric)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            try:
+                metric_lines = metric.render()
+            except Exception:
+                logger.exception("failed to collect {}".format(metric.name))
+                continue
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            lines.extend(metric_lines)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = dict()
+        registry.register(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        with self._lock:
+            values = list(self._values.items())
+        return [
+            "{}{} {}".format(self.name, _format_labels(self.labelnames, key), value) for key, value in values
+        ]
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # labels -> [bucket counts..., +Inf count, sum]
+        self._values = dict()
+        registry.register(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+            values[-2] += 1
+            values[-1] += value
+
+    def render(self) -> list:
+        with self._lock:
+            values = [(key, list(value)) for key, value in self._values.items()]
+        lines = []
+        for key, value in values:
+            for bound, count in zip(self.buckets, value):
+                lines.append("{}_bucket{} {}".format(
+                    self.name, _format_labels(self.labelnames, key, 'le="{}"'.format(bound)), count
+                ))
+            lines.append("{}_bucket{} {}".format(self.name, _format_labels(self.labelnames, key, 'le="+Inf"'), value[-2]))
+            lines.append("{}_count{} {}".format(self.name, _format_labels(self.labelnames, key), value[-2]))
+            lines.append("{}_sum{} {}".format(self.name, _format_labels(self.labelnames, key), value[-1]))
+        return lines
+
+
+class CallbackMetric:
+    # Value read from existing objects on every scrape, e.g. pool stats or cache hit counters.
+    # callback returns (label values, value) pairs.
+    def __init__(self, name: str, help: str, type: str, labelnames, callback, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        registry.register(self)
+
+    def render(self) -> list:
+        return [
+            "{}{} {}".format(self.name, _format_labels(self.labelnames, key), value)
+            for key, value in self.callback()
+        ]
+
+
+STAGE_SECONDS = Histogram(
+    "bot_stage_seconds", "Time spent in one stage of a request.", ["stage"]
+)
+HANDLER_SECONDS = Histogram(
+    "bot_handler_seconds", "Time spent handling an update.", ["handler"]
+)
+CACHE_REQUESTS = Counter(
+    "bot_cache_requests_total", "Cache lookups by cache and result.", ["cache", "result"]
+)
+ERRORS = Counter(
+    "bot_errors_total", "Errors by exception type.", ["type"]
+)
+
+# stage durations of the request handled by the current task, see timed_handler
+_trace = contextvars.ContextVar("trace", default=None)
+
+
+def observe_stage(stage: str, seconds: float):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    trace = _trace.get()
+    if trace is not None:
+        trace[stage] = trace.get(stage, 0) + seconds
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+
+def count_cache(cache: str, hit: bool):
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def timed_handler(name: str, callback):
+    # Wraps a handler callback: records its duration and logs one key=value line with the
+    # duration of every stage the request went through.
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        trace = dict()
+        token = _trace.set(trace)
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            return await callback(update, context)
+        except BaseException as e:
+            status = type(e).__name__
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            _trace.reset(token)
+            HANDLER_SECONDS.observe(duration, handler=name)
+            chat = getattr(getattr(update, "effective_chat", None), "id", None)
+            request_logger.info("handler={} chat={} status={} duration_ms={:.1f}{}".format(
+                name,
+                chat,
+                status,
+                duration * 1000,
+                "".join(" {}_ms={:.1f}".format(key, value * 1000) for key, value in trace.items())
+            ))
+    return wrapper
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(host: str, port: int) -> http.server.ThreadingHTTPServer:
+    # Serves /metrics in the Prometheus text format from a daemon thread.
+    server = http.server.ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("metrics on http://{}:{}/metrics".format(host, port))
+    return server
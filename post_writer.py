@@ -0,0 +1,205 @@
+import asyncio
+import collections
+import logging
+
+import medialib_db
+
+logger = logging.getLogger(__name__)
+
+
+class PostWriter:
+    # Write-behind queue for post registration. Post ids are handed out from a block
+    # reserved from the post id sequence, and the rows are inserted later in one multi-row
+    # statement. Posts which are not written yet are still visible through get_pending().
+    # A batch that fails is split until the failing rows are found, so one bad row does not
+    # hold back the others. A row that failed max_attempts times is registered with
+    # medialib_db.register_post under a new id instead. Above max_pending queued posts,
+    # new posts are registered directly too.
+    def __init__(
+            self, db, pool, table: str, id_sequence: str,
+            id_block_size: int, flush_interval: float, max_batch: int,
+            max_pending: int, max_attempts: int
+    ):
+        self._db = db
+        self._pool = pool
+        self.table = table
+        self.id_sequence = id_sequence
+        self.id_block_size = id_block_size
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self._ids = collections.deque()
+        self._reserve_task = None
+        self._pending = collections.OrderedDict()
+        # post id -> failed attempts to write it
+        self._attempts = dict()
+        # post id handed out to the user -> row registered under a new id by the fallback
+        self._moved = collections.OrderedDict()
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self._flusher = None
+
+    def start(self):
+        self._flusher = asyncio.create_task(self._flush_periodically())
+
+    def _reserve_ids(self, count, connection):
+        cursor = connection.cursor()
+        cursor.execute("SELECT nextval(%s) FROM generate_series(1, %s)", (self.id_sequence, count))
+        ids = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        connection.commit()
+        return ids
+
+    async def _reserve(self, connection=None):
+        if connection is None:
+            ids = await self._pool.call(self._reserve_ids, self.id_block_size)
+        else:
+            ids = await self._db.run(self._reserve_ids, self.id_block_size, connection)
+        self._ids.extend(ids)
+
+    async def _reserve_in_background(self):
+        try:
+            await self._reserve()
+        except Exception:
+            logger.exception("failed to reserve post ids")
+
+    async def register_post(self, user_id, content_id, connection) -> int:
+        # The caller's connection is only used when no reserved id is left, refills of the
+        # id block run in the background on a connection of their own.
+        if len(self._pending) >= self.max_pending:
+            return await self._db.run(medialib_db.register_post, user_id, content_id, connection)
+        if len(self._ids) == 0:
+            await self._reserve(connection)
+        post_id = self._ids.popleft()
+        if len(self._ids) < self.id_block_size // 4 and (self._reserve_task is None or self._reserve_task.done()):
+            self._reserve_task = asyncio.create_task(self._reserve_in_background())
+        self._pending[post_id] = (post_id, user_id, content_id)
+        if len(self._pending) >= self.max_batch and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+        return post_id
+
+    async def register_posts(self, user_id, content_ids, connection) -> list:
+        while len(self._ids) < len(content_ids):
+            await self._reserve(connection)
+        return [await self.register_post(user_id, content_id, connection) for content_id in content_ids]
+
+    def get_pending(self, post_id):
+        if post_id in self._moved:
+            return self._moved[post_id]
+        return self._pending.get(post_id)
+
+    def _insert_posts(self, rows, connection):
+        cursor = connection.cursor()
+        values = ", ".join(["(%s, %s, %s)"] * len(rows))
+        cursor.execute(
+            "INSERT INTO {} (ID, user_id, content_id) VALUES {}".format(self.table, values),
+            [value for row in rows for value in row]
+        )
+        cursor.close()
+        connection.commit()
+
+    def _write_posts(self, rows, connection) -> list:
+        # Returns the rows which could not be written. A failed batch is retried in halves.
+        try:
+            self._insert_posts(rows, connection)
+            return []
+        except Exception:
+            # fails too if the connection is broken, then the whole flush is retried later
+            connection.rollback()
+            if len(rows) == 1:
+                logger.exception("failed to write post {}".format(rows[0]))
+                return rows
+        middle = len(rows) // 2
+        return self._write_posts(rows[:middle], connection) + self._write_posts(rows[middle:], connection)
+
+    @staticmethod
+    def _register_directly(rows, connection) -> dict:
+        # post id handed out -> row registered by medialib_db
+        moved = dict()
+        for post_id, user_id, content_id in rows:
+            try:
+                moved[post_id] = (medialib_db.register_post(user_id, content_id, connection), user_id, content_id)
+            except Exception:
+                logger.exception("failed to register post {}".format(post_id))
+                connection.rollback()
+        return moved
+
+    async def _fall_back(self, rows):
+        moved = await self._pool.call(self._register_directly, rows)
+        for post_id, row in moved.items():
+            logger.warning("post {} could not be written, registered as post {}".format(post_id, row[0]))
+            del self._pending[post_id]
+            del self._attempts[post_id]
+            self._moved[post_id] = row
+            if len(self._moved) > self.max_pending:
+                self._moved.popitem(last=False)
+
+    async def flush(self):
+        async with self._flush_lock:
+            # every queued row is tried once per flush
+            tried = set()
+            while True:
+                rows = [row for post_id, row in self._pending.items() if post_id not in tried][:self.max_batch]
+                if len(rows) == 0:
+                    break
+                try:
+                    failed = await self._pool.call(self._write_posts, rows)
+                except Exception:
+                    logger.exception("failed to write {} posts, will retry".format(len(rows)))
+                    return
+                failed_ids = {row[0] for row in failed}
+                for row in rows:
+                    tried.add(row[0])
+                    if row[0] not in failed_ids:
+                        del self._pending[row[0]]
+                        self._attempts.pop(row[0], None)
+                give_up = []
+                for row in failed:
+                    self._attempts[row[0]] = self._attempts.get(row[0], 0) + 1
+                    if self._attempts[row[0]] >= self.max_attempts:
+                        give_up.append(row)
+                if len(give_up):
+                    try:
+                        await self._fall_back(give_up)
+                    except Exception:
+                        logger.exception("failed to register {} posts, will retry".format(len(give_up)))
+                        return
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+        await self.flush()
+        if len(self._pending):
+            logger.error("{} posts were not written: {}".format(len(self._pending), list(self._pending.values())))
+
+
+class DirectPostWriter:
+    # Registers every post right away with medialib_db.register_post.
+    def __init__(self, db):
+        self._db = db
+
+    def start(self):
+        pass
+
+    async def register_post(self, user_id, content_id, connection) -> int:
+        return await self._db.run(medialib_db.register_post, user_id, content_id, connection)
+
+    @staticmethod
+    def _register_posts(user_id, content_ids, connection) -> list:
+        return [medialib_db.register_post(user_id, content_id, connection) for content_id in content_ids]
+
+    async def register_posts(self, user_id, content_ids, connection) -> list:
+        # one executor call for all of them
+        return await self._db.run(self._register_posts, user_id, content_ids, connection)
+
+    def get_pending(self, post_id):
+        return None
+
+    async def close(self):
+        pass
@@ -0,0 +1,95 @@
+import hashlib
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_SUFFIX = ".webp"
+
+
+def atomic_write(path: pathlib.Path, data):
+    # data may be any bytes-like object, a memoryview is written without copying.
+    path.parent.mkdir(exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+class PreviewCache:
+    # Directory of encoded previews named after the content id and the mtime and size of the
+    # source file, so a changed source never hits a stale preview. File mtime is used as the
+    # last access time for LRU eviction once the directory grows beyond max_size bytes.
+    def __init__(self, directory, max_size: int):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._size = 0
+        for entry in self._entries():
+            self._size += entry[2]
+
+    def _entries(self):
+        entries = []
+        for subdirectory in self.directory.iterdir():
+            if not subdirectory.is_dir():
+                continue
+            with os.scandir(subdirectory) as it:
+                for entry in it:
+                    if not entry.name.endswith(PREVIEW_SUFFIX):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime_ns, entry.path, stat.st_size))
+        return entries
+
+    def path_for(self, content_id: int, fingerprint) -> pathlib.Path:
+        key = hashlib.sha1("{}:{}:{}".format(content_id, fingerprint[0], fingerprint[1]).encode()).hexdigest()
+        return self.directory.joinpath(key[:2], key + PREVIEW_SUFFIX)
+
+    def get(self, content_id: int, fingerprint):
+        if fingerprint is None:
+            return None
+        path = self.path_for(content_id, fingerprint)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def account(self, size: int):
+        # Registers size bytes written into the cache directory, possibly by another process.
+        with self._lock:
+            self._size += size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        # Called with the lock held. Shrinks the cache to 90% of max_size, oldest entries first.
+        entries = self._entries()
+        entries.sort()
+        self._size = sum(entry[2] for entry in entries)
+        target_size = self.max_size * 0.9
+        removed = 0
+        for mtime, path, size in entries:
+            if self._size <= target_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+            removed += 1
+        logger.info("preview cache: evicted {} files, {} bytes left".format(removed, self._size))
@@ -0,0 +1,163 @@
+import argparse
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import pathlib
+import time
+
+import medialib_db
+
+import bot_config
+import jpeg_probe
+import transcoder
+from file_id_cache import file_fingerprint
+from preview_cache import PreviewCache
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger("prewarm")
+
+CONTENT_BATCH_QUERY = "SELECT ID, file_path FROM content WHERE ID > %s ORDER BY ID LIMIT %s"
+CONTENT_COUNT_QUERY = "SELECT COUNT(*) FROM content WHERE ID > %s"
+
+
+def load_state(state_file: pathlib.Path) -> int:
+    try:
+        with state_file.open("r") as f:
+            return json.load(f)["last_content_id"]
+    except FileNotFoundError:
+        return 0
+
+
+def save_state(state_file: pathlib.Path, last_content_id: int):
+    tmp_file = state_file.with_name(state_file.name + ".tmp")
+    with tmp_file.open("w") as f:
+        json.dump({"last_content_id": last_content_id}, f)
+    os.replace(tmp_file, state_file)
+
+
+def index_representations(content_id, file_path, connection) -> bool:
+    representations = medialib_db.get_representation_by_content_id(content_id, connection)
+    if len(representations):
+        return False
+    cursor = connection.cursor()
+    medialib_db.srs_indexer.srs_update_representations(content_id, file_path, cursor)
+    connection.commit()
+    cursor.close()
+    return True
+
+
+def preview_source(content_id, file_path: pathlib.Path, probe_cache: jpeg_probe.JPEGProbeCache):
+    # Mirrors the choice get_image makes in main.py: only these files are sent as previews.
+    if file_path.suffix in {".srs", ".webp", ".avif"}:
+        return None
+    if file_path.suffix in {".jpeg", ".jpg"}:
+        if probe_cache.probe(content_id, file_path) != jpeg_probe.ARITHMETIC:
+            return None
+    return file_path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Index missing SRS representations, classify JPEG files and generate previews ahead of time."
+    )
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=bot_config.TRANSCODER_WORKERS)
+    parser.add_argument("--state-file", type=pathlib.Path, default=pathlib.Path("prewarm_state.json"))
+    parser.add_argument("--restart", action="store_true", help="ignore saved progress and start from the beginning")
+    parser.add_argument("--no-previews", action="store_true")
+    args = parser.parse_args()
+
+    last_content_id = 0 if args.restart else load_state(args.state_file)
+    if last_content_id:
+        logger.info("resume after content id {}".format(last_content_id))
+
+    probe_cache = jpeg_probe.JPEGProbeCache(bot_config.FILE_ID_CACHE_PATH)
+    preview_cache = None
+    if not args.no_previews and bot_config.PREVIEW_CACHE_DIR is not None:
+        preview_cache = PreviewCache(bot_config.PREVIEW_CACHE_DIR, bot_config.PREVIEW_CACHE_MAX_SIZE)
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=args.workers, mp_context=multiprocessing.get_context("spawn")
+    )
+    connection = medialib_db.common.make_connection()
+    cursor = connection.cursor()
+    cursor.execute(CONTENT_COUNT_QUERY, (last_content_id,))
+    total = cursor.fetchone()[0]
+
+    processed = 0
+    indexed = 0
+    previews = 0
+    errors = 0
+    start_time = time.monotonic()
+    try:
+        while True:
+            cursor.execute(CONTENT_BATCH_QUERY, (last_content_id, args.batch_size))
+            rows = cursor.fetchall()
+            if len(rows) == 0:
+                break
+            futures = {}
+            for content_id, relative_path in rows:
+                file_path = medialib_db.config.relative_to.joinpath(relative_path)
+                try:
+                    if file_path.suffix == ".srs":
+                        if index_representations(content_id, file_path, connection):
+                            indexed += 1
+                        continue
+                    if preview_cache is None:
+                        continue
+                    source = preview_source(content_id, file_path, probe_cache)
+                    if source is None:
+                        continue
+                    fingerprint = file_fingerprint(source)
+                    if fingerprint is None:
+                        logger.warning("content id {}: file {} not found".format(content_id, source))
+                        errors += 1
+                        continue
+                    if preview_cache.get(content_id, fingerprint) is None:
+                        future = executor.submit(
+                            transcoder.make_preview,
+                            source,
+                            preview_cache.path_for(content_id, fingerprint),
+                            None,
+                            bot_config.PREVIEW_MEMORY_BUDGET
+                        )
+                        futures[future] = content_id
+                except Exception:
+                    logger.exception("content id {}: failed to prepare {}".format(content_id, file_path))
+                    connection.rollback()
+                    errors += 1
+            for future in concurrent.futures.as_completed(futures):
+                content_id = futures[future]
+                try:
+                    preview_size = future.result()
+                except Exception:
+                    logger.exception("content id {}: failed to make preview".format(content_id))
+                    errors += 1
+                    continue
+                if preview_size:
+                    preview_cache.account(preview_size)
+                    previews += 1
+
+            last_content_id = rows[-1][0]
+            save_state(args.state_file, last_content_id)
+            processed += len(rows)
+            elapsed = time.monotonic() - start_time
+            logger.info(
+                "{}/{} processed ({:.1f}/s), {} SRS indexed, {} previews, {} errors, last content id {}".format(
+                    processed, total, processed / elapsed, indexed, previews, errors, last_content_id
+                )
+            )
+    finally:
+        cursor.close()
+        connection.close()
+        executor.shutdown(cancel_futures=True)
+        probe_cache.close()
+    logger.info("done: {} processed, {} SRS indexed, {} previews, {} errors".format(processed, indexed, previews, errors))
+
+
+if __name__ == '__main__':
+    main()
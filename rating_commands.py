@@ -0,0 +1,124 @@
+import enum
+import logging
+import re
+
+import telegram.constants
+import medialib_db
+import secrets
+
+
+logger = logging.getLogger(__name__)
+
+ORIENTATION_WORDS = ["bisexual", "gay", "futa", "intersex", "lesbian", "transgender", "solo male"]
+
+# "/safe x5 tag_a": a leading xN asks for an album of N images
+COUNT_PATTERN = re.compile(r"x(\d+)")
+MAX_COUNT = telegram.constants.MediaGroupLimit.MAX_MEDIA_LENGTH
+
+
+def split_count(query_string: str):
+    # Returns the requested number of images, clamped to the album size limit, and the rest
+    # of the query.
+    words = query_string.split(" ", 1)
+    match = COUNT_PATTERN.fullmatch(words[0])
+    if match is None:
+        return 1, query_string
+    count = min(max(int(match.group(1)), 1), MAX_COUNT)
+    return count, words[1] if len(words) == 2 else ''
+
+
+class SPOILER(enum.Enum):
+    NEVER = enum.auto()
+    GROUP_CHATS = enum.auto()
+
+
+class RatingCommand:
+    # A /safe like command: a random image carrying (or, with exclude_rating, not carrying)
+    # rating_tag, for chats with at least min_access_level. None only keeps banned users out.
+    # content_filters adds the bad words exclusions, and the orientation exclusions from
+    # the GAY access level on.
+    def __init__(
+            self,
+            name: str,
+            rating_tag: str,
+            exclude_rating=False,
+            min_access_level=None,
+            spoiler=SPOILER.GROUP_CHATS,
+            content_filters=True
+    ):
+        self.name = name
+        self.rating_tag = rating_tag
+        self.exclude_rating = exclude_rating
+        self.min_access_level = min_access_level
+        self.spoiler = spoiler
+        self.content_filters = content_filters
+
+    def denied_text(self, permission_level, unknown_command_text: str):
+        if self.min_access_level is None:
+            if permission_level == medialib_db.ACCESS_LEVEL.BAN:
+                return "you are not allowed to do this request"
+        elif permission_level < self.min_access_level:
+            return unknown_command_text
+        return None
+
+    def filter_pride(self, permission_level) -> bool:
+        return self.content_filters and permission_level >= medialib_db.ACCESS_LEVEL.GAY
+
+    def has_spoiler(self, chat_type) -> bool:
+        if self.spoiler == SPOILER.NEVER:
+            return False
+        return chat_type != telegram.constants.ChatType.PRIVATE
+
+    def tags_groups(self, rating_filters, permission_level) -> list:
+        tags_groups = [rating_filters.rating_groups[self.name]]
+        if self.content_filters:
+            tags_groups.extend(rating_filters.bad_tags)
+            if self.filter_pride(permission_level):
+                tags_groups.extend(rating_filters.pride_tags)
+        return tags_groups
+
+
+RATING_COMMANDS = (
+    RatingCommand("safe", "safe", spoiler=SPOILER.NEVER, content_filters=False),
+    RatingCommand("suggestive", "suggestive", min_access_level=medialib_db.ACCESS_LEVEL.SUGGESTIVE),
+    RatingCommand("nsfw", "safe", exclude_rating=True, min_access_level=medialib_db.ACCESS_LEVEL.NSFW),
+    RatingCommand("explicit", "explicit", min_access_level=medialib_db.ACCESS_LEVEL.NSFW),
+)
+
+
+class RatingFilters:
+    # The static tag groups of RATING_COMMANDS resolved to tag ids, so searches don't look
+    # the tag names up on every query. resolve is a TagResolver listener: the groups are
+    # resolved again whenever the resolver loads or picks up new tags.
+    def __init__(self, commands, tag_resolver):
+        self._commands = commands
+        self._tag_resolver = tag_resolver
+        self.bad_tags = []
+        self.pride_tags = []
+        self.rating_groups = {
+            command.name: {"not": command.exclude_rating, "tags": [command.rating_tag], "count": 1}
+            for command in commands
+        }
+
+    def resolve(self, connection):
+        bad_words = list(secrets.bad_words)
+        titles = set(bad_words) | set(ORIENTATION_WORDS) | {command.rating_tag for command in self._commands}
+        tag_ids = self._tag_resolver.lookup(titles, connection)
+        rating_groups = dict()
+        for command in self._commands:
+            # an unknown rating tag is kept by name, so the search still matches nothing for it
+            tag = tag_ids.get(command.rating_tag, command.rating_tag)
+            rating_groups[command.name] = {"not": command.exclude_rating, "tags": [tag], "count": 1}
+        self.bad_tags = self._exclusion_groups(bad_words, tag_ids)
+        self.pride_tags = self._exclusion_groups(ORIENTATION_WORDS, tag_ids)
+        self.rating_groups = rating_groups
+
+    @staticmethod
+    def _exclusion_groups(titles, tag_ids) -> list:
+        groups = []
+        for title in titles:
+            if title not in tag_ids:
+                logger.info("filter tag \"{}\" not found, skipped".format(title))
+                continue
+            groups.append({"not": True, "tags": [tag_ids[title]], "count": 1})
+        return groups
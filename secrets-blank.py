@@ -1,3 +1,127 @@
 API_key = "leave API key here"
 
 bad_words = []
+
+# medialib_db access layer; db_workers defaults to 8, db_max_concurrency and
+# db_pool_max_size to db_workers
+# db_workers = 8
+# db_max_concurrency = 8
+db_call_timeout = 30
+db_pool_min_size = 1
+# db_pool_max_size = 8
+# seconds before an idle connection above db_pool_min_size is closed
+db_pool_max_idle_time = 300
+# connections idle for more seconds are checked with SELECT 1 before they are used
+db_pool_health_check_after = 30
+
+# local store of Telegram file_ids of already uploaded content
+file_id_cache_path = "bot_cache.sqlite"
+
+# preview encoding process pool, defaults to the number of CPU cores
+# transcoder_workers = 4
+# how many previews may wait for a free worker before new requests are rejected
+# transcoder_queue_depth = 8
+# bytes of decoded pixels a preview may take (JPEG decodes at a reduced scale first),
+# larger images are sent without a preview
+preview_memory_budget = 512 * 1024 ** 2
+# /animation POST_ID: GIF preview of at most this many first frames of an animation,
+# their scaled down copies taking at most animated_preview_memory_budget bytes
+animated_preview_max_frames = 50
+animated_preview_memory_budget = 64 * 1024 ** 2
+
+# directory of encoded previews, None disables the cache
+preview_cache_dir = "preview_cache"
+# bytes, least recently used previews are removed above this size
+preview_cache_max_size = 1024 ** 3
+
+# random image commands are served from a batch of candidate_batch_size random results per query,
+# refilled in the background below candidate_low_watermark rows and dropped after candidate_ttl seconds
+candidate_batch_size = 200
+candidate_low_watermark = 20
+candidate_ttl = 600
+candidate_pool_max_queries = 1000
+
+# outgoing messages per second, Telegram flood limits by default (global_message_rate is 30)
+# global_message_rate = 30
+private_chat_message_rate = 1
+group_chat_message_rate = 20 / 60
+chat_message_burst = 3
+
+# /tag wildcard results are loaded and sent in pages of this many tags
+tag_search_page_size = 100
+
+# inline mode (enable it with /setinline in @BotFather): "@bot nsfw tag_a not tag_b" answers
+# with up to inline_page_size of the newest matching images that were already sent once,
+# Telegram may reuse an answer for inline_cache_time seconds
+inline_page_size = 50
+inline_cache_time = 300
+# an answer reads search results until it has inline_page_size images, the search runs
+# out, or inline_max_scanned results were read; then it offers what it found, and no more
+# pages if that is nothing
+inline_max_scanned = 1000
+
+# registered users and chats are kept in memory for access_cache_ttl seconds,
+# so access level changes take effect after that time or after /refresh
+access_cache_size = 10000
+access_cache_ttl = 300
+
+# insert posts in batches every post_flush_interval seconds instead of one by one,
+# post ids are reserved from post_id_sequence in blocks of post_id_block_size;
+# posts are registered one by one while post_max_pending posts wait to be written, and
+# a post that failed to be written post_flush_max_attempts times is registered one by one
+# under a new post id
+post_write_behind = False
+post_table = "telegram_bot_post"
+post_id_sequence = "telegram_bot_post_id_seq"
+post_id_block_size = 100
+post_flush_interval = 1
+post_flush_max_batch = 500
+post_max_pending = 10000
+post_flush_max_attempts = 3
+
+# photos and documents uploaded to Telegram at the same time
+max_concurrent_uploads = 8
+
+# updates processed at the same time
+concurrent_updates = 64
+# Bot API server, e.g. "http://127.0.0.1:8081/bot" for benchmarks/fake_telegram_api.py
+telegram_api_base_url = None
+telegram_api_base_file_url = None
+
+# set webhook_url to receive updates through a webhook served on webhook_listen:webhook_port
+# (usually behind a reverse proxy) instead of long polling
+webhook_url = None
+webhook_listen = "127.0.0.1"
+webhook_port = 8443
+webhook_path = ""
+webhook_secret_token = None
+webhook_max_connections = 40
+
+# sharded_bot.py runs shard_workers bot processes (one per CPU core if None) behind one
+# ingress that routes updates by chat id. Every worker has its own DB pool, transcoder,
+# message rate limits and caches. The defaults of db_workers (and so db_pool_max_size),
+# transcoder_workers and global_message_rate are divided between the workers, values set
+# here apply to every worker. With post_write_behind a post registered by one worker is
+# found by the others after its next flush, /best, /webp and /animation look a post up
+# once more after post_flush_interval before they answer "Post not found."
+shard_workers = None
+# updates waiting for a worker before the ingress stops taking new ones
+shard_queue_size = 1000
+# seconds before a crashed worker is started again
+shard_restart_delay = 5
+# seconds between logged shard statistics
+shard_stats_interval = 60
+
+# tag names of queries are resolved from an in-memory dictionary: tags added since the last
+# check are fetched every tag_resolver_refresh_interval seconds, the whole dictionary is
+# reloaded every tag_resolver_reload_interval seconds (renamed and removed tags)
+tag_resolver_refresh_interval = 60
+tag_resolver_reload_interval = 3600
+# tag names not found in the database are not looked up again for unknown_tag_ttl seconds
+unknown_tag_ttl = 60
+unknown_tag_cache_size = 10000
+
+# serve Prometheus metrics (stage timings, cache hits, pool usage, errors) on
+# http://metrics_listen:metrics_port/metrics; sharded_bot.py workers use the following ports
+metrics_listen = "127.0.0.1"
+metrics_port = None
@@ -0,0 +1,252 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+from telegram import Bot, Update
+from telegram.ext import Updater
+
+import bot_config
+import main
+import metrics
+import secrets
+
+logger = logging.getLogger("sharded_bot")
+
+# per worker slots in the shared statistics array
+PROCESSED = 0
+IN_FLIGHT = 1
+STATS_SLOTS = 2
+
+
+def shard_key(update: Update) -> int:
+    # Updates of one chat always go to the same worker, which keeps them in order.
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return update.update_id
+
+
+class ChatLocks:
+    # One lock per chat with pending updates, dropped once nobody waits on it.
+    def __init__(self):
+        self._locks = dict()
+
+    def acquire(self, key):
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, key):
+        entry = self._locks[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._locks[key]
+
+
+async def process_update(application, update, chat_locks, slots, stats, offset):
+    key = shard_key(update)
+    lock = chat_locks.acquire(key)
+    try:
+        async with lock:
+            stats[offset + IN_FLIGHT] += 1
+            try:
+                await application.process_update(update)
+            finally:
+                stats[offset + IN_FLIGHT] -= 1
+                stats[offset + PROCESSED] += 1
+    finally:
+        chat_locks.release(key)
+        slots.release()
+
+
+async def serve_shard(index, updates, stats):
+    application = main.build_application(updater=False)
+    if bot_config.METRICS_PORT is not None:
+        # the ingress serves METRICS_PORT, every worker the port after it plus its index
+        metrics.start_http_server(bot_config.METRICS_LISTEN, bot_config.METRICS_PORT + 1 + index)
+    loop = asyncio.get_running_loop()
+    offset = index * STATS_SLOTS
+    slots = asyncio.Semaphore(bot_config.CONCURRENT_UPDATES)
+    chat_locks = ChatLocks()
+    tasks = set()
+
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    logger.info("shard {} started, pid {}".format(index, os.getpid()))
+    try:
+        while True:
+            await slots.acquire()
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            # tasks are started in arrival order and queue on the chat lock in that order
+            task = asyncio.create_task(process_update(
+                application, Update.de_json(data, application.bot), chat_locks, slots, stats, offset
+            ))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+    finally:
+        await application.stop()
+        await application.shutdown()
+        await application.post_shutdown(application)
+        logger.info("shard {} stopped".format(index))
+
+
+def run_shard(index, updates, stats):
+    # Ctrl+C reaches the whole process group, the ingress stops the workers in order instead.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_shard(index, updates, stats))
+
+
+class Shard:
+    def __init__(self, context, index, stats):
+        self.context = context
+        self.index = index
+        self.stats = stats
+        self.updates = context.Queue(bot_config.SHARD_QUEUE_SIZE)
+        self.process = None
+        self.restarts = 0
+        self.died_at = None
+
+    def start(self):
+        self.process = self.context.Process(
+            target=run_shard, args=(self.index, self.updates, self.stats), name="shard-{}".format(self.index)
+        )
+        self.process.start()
+
+    def supervise(self):
+        if self.process.is_alive():
+            return
+        if self.died_at is None:
+            self.died_at = time.monotonic()
+            logger.error("shard {} exited with code {}".format(self.index, self.process.exitcode))
+        if time.monotonic() - self.died_at >= bot_config.SHARD_RESTART_DELAY:
+            self.died_at = None
+            self.restarts += 1
+            self.start()
+
+    def describe(self) -> str:
+        offset = self.index * STATS_SLOTS
+        return "shard {}: queued {}, in flight {}, processed {}, restarts {}".format(
+            self.index,
+            self.updates.qsize(),
+            self.stats[offset + IN_FLIGHT],
+            self.stats[offset + PROCESSED],
+            self.restarts
+        )
+
+
+def register_shard_metrics(shards):
+    def shard_values(slot):
+        return lambda: [((shard.index,), shard.stats[shard.index * STATS_SLOTS + slot]) for shard in shards]
+
+    metrics.CallbackMetric(
+        "bot_shard_processed_updates_total", "Updates processed by a worker.", "counter", ["shard"],
+        shard_values(PROCESSED)
+    )
+    metrics.CallbackMetric(
+        "bot_shard_updates_in_flight", "Updates a worker is processing.", "gauge", ["shard"],
+        shard_values(IN_FLIGHT)
+    )
+    metrics.CallbackMetric(
+        "bot_shard_queued_updates", "Updates waiting for a worker.", "gauge", ["shard"],
+        lambda: [((shard.index,), shard.updates.qsize()) for shard in shards]
+    )
+    metrics.CallbackMetric(
+        "bot_shard_restarts_total", "Worker restarts after a crash.", "counter", ["shard"],
+        lambda: [((shard.index,), shard.restarts) for shard in shards]
+    )
+
+
+async def supervise(shards):
+    last_report = time.monotonic()
+    while True:
+        for shard in shards:
+            shard.supervise()
+        if time.monotonic() - last_report >= bot_config.SHARD_STATS_INTERVAL:
+            last_report = time.monotonic()
+            logger.info("processed {} updates in total".format(
+                sum(shard.stats[shard.index * STATS_SLOTS + PROCESSED] for shard in shards)
+            ))
+            for shard in shards:
+                logger.info(shard.describe())
+        await asyncio.sleep(1)
+
+
+async def route(update_queue: asyncio.Queue, shards):
+    loop = asyncio.get_running_loop()
+    while True:
+        update = await update_queue.get()
+        if update is None:
+            return
+        shard = shards[shard_key(update) % len(shards)]
+        # blocks while the worker is behind, which in turn stops fetching new updates
+        await loop.run_in_executor(None, shard.updates.put, update.to_dict())
+
+
+async def serve(workers: int):
+    # read by bot_config in the spawned workers
+    os.environ[bot_config.SHARDS_ENVIRONMENT_VARIABLE] = str(workers)
+    context = multiprocessing.get_context("spawn")
+    stats = context.Array("q", workers * STATS_SLOTS, lock=False)
+    shards = [Shard(context, index, stats) for index in range(workers)]
+    for shard in shards:
+        shard.start()
+    if bot_config.METRICS_PORT is not None:
+        register_shard_metrics(shards)
+        metrics.start_http_server(bot_config.METRICS_LISTEN, bot_config.METRICS_PORT)
+
+    bot_options = dict()
+    if bot_config.TELEGRAM_API_BASE_URL is not None:
+        bot_options["base_url"] = bot_config.TELEGRAM_API_BASE_URL
+    if bot_config.TELEGRAM_API_BASE_FILE_URL is not None:
+        bot_options["base_file_url"] = bot_config.TELEGRAM_API_BASE_FILE_URL
+    update_queue = asyncio.Queue()
+    updater = Updater(Bot(secrets.API_key, **bot_options), update_queue)
+
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+
+    await updater.initialize()
+    if bot_config.WEBHOOK_URL is not None:
+        await updater.start_webhook(
+            listen=bot_config.WEBHOOK_LISTEN,
+            port=bot_config.WEBHOOK_PORT,
+            url_path=bot_config.WEBHOOK_PATH,
+            webhook_url=bot_config.WEBHOOK_URL,
+            secret_token=bot_config.WEBHOOK_SECRET_TOKEN,
+            max_connections=bot_config.WEBHOOK_MAX_CONNECTIONS
+        )
+    else:
+        await updater.start_polling()
+    logger.info("routing updates to {} workers".format(workers))
+    router = asyncio.create_task(route(update_queue, shards))
+    supervisor = asyncio.create_task(supervise(shards))
+
+    await stopping.wait()
+    logger.info("stopping")
+    # stop taking updates, hand the fetched ones to the workers, then let every worker
+    # finish its queue before it shuts down
+    await updater.stop()
+    await updater.shutdown()
+    await update_queue.put(None)
+    await router
+    for shard in shards:
+        await loop.run_in_executor(None, shard.updates.put, None)
+    supervisor.cancel()
+    for shard in shards:
+        await loop.run_in_executor(None, shard.process.join)
+        logger.info(shard.describe())
+
+
+if __name__ == '__main__':
+    asyncio.run(serve(bot_config.SHARD_WORKERS or os.cpu_count()))
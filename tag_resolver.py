@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import threading
+import time
+
+import tag_search
+from ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class TagResolver:
+    # In-process tag title/alias -> tag id dictionary. Everything is loaded once; every
+    # refresh_interval seconds only tags with an id above the highest known one are fetched,
+    # and every reload_interval seconds the dictionary is loaded again to drop renamed and
+    # removed tags. A title that is still missing is looked up on its own and, when it is
+    # unknown to the database as well, remembered as unknown for unknown_ttl seconds.
+    # Listeners are called with the connection after every load and every refresh that
+    # added tags.
+    def __init__(
+            self,
+            pool,
+            refresh_interval: float,
+            reload_interval: float,
+            unknown_ttl: float,
+            unknown_cache_size: int
+    ):
+        self._pool = pool
+        self.refresh_interval = refresh_interval
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._tag_ids = dict()
+        self._max_tag_id = 0
+        self._loaded_at = 0
+        self._unknown = TTLCache(unknown_cache_size, unknown_ttl)
+        self._refresher = None
+        self._listeners = []
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def _changed(self, connection):
+        for listener in self._listeners:
+            listener(connection)
+
+    def load(self, connection):
+        tag_ids = tag_search.get_all_tag_ids(connection)
+        with self._lock:
+            self._tag_ids = tag_ids
+            self._max_tag_id = max(tag_ids.values(), default=0)
+            self._loaded_at = time.monotonic()
+        self._unknown.clear()
+        logger.info("tag resolver: loaded {} tag titles".format(len(tag_ids)))
+        self._changed(connection)
+
+    def refresh(self, connection):
+        if time.monotonic() - self._loaded_at >= self.reload_interval:
+            return self.load(connection)
+        tag_ids = tag_search.get_all_tag_ids(connection, self._max_tag_id)
+        if len(tag_ids) == 0:
+            return
+        with self._lock:
+            self._tag_ids.update(tag_ids)
+            self._max_tag_id = max(self._max_tag_id, max(tag_ids.values()))
+        for title in tag_ids:
+            self._unknown.invalidate(title)
+        logger.info("tag resolver: added {} tag titles".format(len(tag_ids)))
+        self._changed(connection)
+
+    def start(self):
+        self._refresher = asyncio.create_task(self._refresh_periodically())
+
+    async def _refresh_periodically(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self._pool.call(self.refresh)
+            except Exception:
+                logger.exception("failed to refresh tags")
+
+    def close(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+
+    def lookup(self, titles, connection) -> dict:
+        # Returns the ids of the known titles, unknown titles are left out.
+        result = dict()
+        missing = []
+        for title in titles:
+            tag_id = self._tag_ids.get(title)
+            if tag_id is not None:
+                result[title] = tag_id
+            elif self._unknown.get(title) is None:
+                missing.append(title)
+        if len(missing):
+            found = tag_search.get_tag_ids_by_titles(missing, connection)
+            with self._lock:
+                self._tag_ids.update(found)
+            for title in missing:
+                if title not in found:
+                    self._unknown.put(title, True)
+            result.update(found)
+        return result
+
+    def resolve_groups(self, tags_groups, connection):
+        # Turns the tag titles of query_parser groups into tag ids. Returns the resolved groups
+        # and the unknown titles of the groups that require tags: such a query can't match
+        # anything. A NOT group with an unknown title is dropped: it excludes content having all
+        # of its tags, and no content has the unknown one.
+        titles = {tag for group in tags_groups for tag in group["tags"] if type(tag) is str and tag != ""}
+        tag_ids = self.lookup(titles, connection)
+        resolved_groups = []
+        unknown_titles = []
+        for group in tags_groups:
+            tags = []
+            excludes_nothing = False
+            for tag in group["tags"]:
+                if type(tag) is int:
+                    tags.append(tag)
+                elif tag == "":
+                    continue
+                elif tag in tag_ids:
+                    tags.append(tag_ids[tag])
+                elif group["not"]:
+                    excludes_nothing = True
+                else:
+                    unknown_titles.append(tag)
+            if len(tags) and not excludes_nothing:
+                resolved_groups.append({"not": group["not"], "tags": tags, "count": len(tags)})
+        return resolved_groups, unknown_titles
@@ -0,0 +1,76 @@
+# Batched tag lookups on top of the medialib_db tag and tag_alias tables.
+
+WILDCARD_TAG_SEARCH_QUERY = (
+    "SELECT tag_alias.tag_id, tag_alias.title, tag.ID, tag.title, tag.category "
+    "FROM tag_alias JOIN tag ON tag.ID = tag_alias.tag_id "
+    "WHERE tag_alias.title LIKE %s{} "
+    "ORDER BY tag_alias.title, tag_alias.tag_id LIMIT %s"
+)
+AFTER_CURSOR_CONDITION = " AND (tag_alias.title, tag_alias.tag_id) > (%s, %s)"
+
+# a tag's own title wins over an alias of another tag with the same text
+TAG_IDS_BY_TITLE_QUERY = (
+    "SELECT title, ID, 0 FROM tag WHERE title = ANY(%s) "
+    "UNION SELECT title, tag_id, 1 FROM tag_alias WHERE title = ANY(%s)"
+)
+ALL_TAG_TITLES_QUERY = "SELECT title, ID, 0 FROM tag UNION SELECT title, tag_id, 1 FROM tag_alias"
+NEW_TAG_TITLES_QUERY = (
+    "SELECT title, ID, 0 FROM tag WHERE ID > %s "
+    "UNION SELECT title, tag_id, 1 FROM tag_alias WHERE tag_id > %s"
+)
+
+
+def wildcard_to_like(wildcard: str) -> str:
+    # "_" is left as LIKE's one-character wildcard, so it matches both "_" and a space
+    return wildcard.replace("\\", "\\\\").replace("%", "\\%").replace("*", "%")
+
+
+def wildcard_tag_search(wildcard: str, connection, limit: int, after=None) -> list:
+    # Returns up to limit (alias tag id, alias title, tag id, tag title, tag category) rows
+    # ordered by alias title. Pass the (alias title, alias tag id) of the last row of a page
+    # as after to get the next page.
+    cursor = connection.cursor()
+    if after is None:
+        cursor.execute(WILDCARD_TAG_SEARCH_QUERY.format(""), (wildcard_to_like(wildcard), limit))
+    else:
+        cursor.execute(
+            WILDCARD_TAG_SEARCH_QUERY.format(AFTER_CURSOR_CONDITION),
+            (wildcard_to_like(wildcard), after[0], after[1], limit)
+        )
+    result = cursor.fetchall()
+    cursor.close()
+    return result
+
+
+def page_cursor(page: list):
+    return page[-1][1], page[-1][0]
+
+
+def _title_ids(rows) -> dict:
+    best = dict()
+    for title, tag_id, priority in rows:
+        if title not in best or (priority, tag_id) < best[title]:
+            best[title] = (priority, tag_id)
+    return {title: entry[1] for title, entry in best.items()}
+
+
+def get_tag_ids_by_titles(titles, connection) -> dict:
+    # Maps every given tag title or alias to the id of the tag it names, unknown titles are left out.
+    titles = list(titles)
+    cursor = connection.cursor()
+    cursor.execute(TAG_IDS_BY_TITLE_QUERY, (titles, titles))
+    result = _title_ids(cursor.fetchall())
+    cursor.close()
+    return result
+
+
+def get_all_tag_ids(connection, after_tag_id=0) -> dict:
+    # Same mapping for all tags (and their aliases) with an id above after_tag_id.
+    cursor = connection.cursor()
+    if after_tag_id:
+        cursor.execute(NEW_TAG_TITLES_QUERY, (after_tag_id, after_tag_id))
+    else:
+        cursor.execute(ALL_TAG_TITLES_QUERY)
+    result = _title_ids(cursor.fetchall())
+    cursor.close()
+    return result
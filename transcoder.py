@@ -0,0 +1,233 @@
+import asyncio
+import concurrent.futures
+import io
+import logging
+import multiprocessing
+import pathlib
+import time
+
+import PIL.Image
+import pyimglib
+
+import metrics
+from preview_cache import atomic_write
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_SIZE = (1024, 1024)
+ANIMATED_PREVIEW_SIZE = (512, 512)
+
+# Pillow opens these lazily: only the first frame of an animation is decoded on load()
+FIRST_FRAME_FORMATS = {".png", ".apng", ".gif", ".webp"}
+ANIMATED_FORMATS = FIRST_FRAME_FORMATS
+
+# Pillow scales these modes down with NEAREST, previews convert them first
+NEAREST_MODES = {"1": "L", "P": "RGB", "PA": "RGBA"}
+
+
+class TranscoderBusy(Exception):
+    pass
+
+
+class TranscoderCrashed(Exception):
+    pass
+
+
+class PreviewTooLarge(Exception):
+    pass
+
+
+def preview_mode(img) -> str:
+    if img.mode == "P" and "transparency" in img.info:
+        return "RGBA"
+    return NEAREST_MODES.get(img.mode, img.mode)
+
+
+def decoded_size(img) -> int:
+    # counted in the mode the preview is scaled down in
+    return img.size[0] * img.size[1] * PIL.Image.getmodebands(preview_mode(img))
+
+
+def open_image(file_path: pathlib.Path):
+    # Pillow refuses images above twice MAX_IMAGE_PIXELS, these are too large for a preview anyway
+    try:
+        return PIL.Image.open(file_path)
+    except PIL.Image.DecompressionBombError as e:
+        raise PreviewTooLarge("{}: {}".format(file_path, e))
+
+
+def header_decoded_size(file_path: pathlib.Path):
+    # decoded size at full scale read from the file header, None if Pillow can't read the header
+    try:
+        with open_image(file_path) as img:
+            return decoded_size(img)
+    except OSError:
+        return None
+
+
+def open_preview_source(file_path: pathlib.Path, size, memory_budget: int = None):
+    # Opens the first frame without decoding it yet. JPEG is set up to decode right at the
+    # smallest DCT scale (1/2 to 1/8) that still covers size; other formats decode in full,
+    # so memory_budget bounds their decoded size.
+    if file_path.suffix.lower() in FIRST_FRAME_FORMATS:
+        img = open_image(file_path)
+    else:
+        # pyimglib decodes the whole image (arithmetic coded JPEG included) on open, so the
+        # budget is checked against the header first where Pillow can read it
+        if memory_budget is not None:
+            full_size = header_decoded_size(file_path)
+            if full_size is not None and full_size > memory_budget:
+                raise PreviewTooLarge("{} decodes to {} bytes".format(file_path, full_size))
+        try:
+            img = pyimglib.decoders.open_image(file_path)
+        except PIL.Image.DecompressionBombError as e:
+            raise PreviewTooLarge("{}: {}".format(file_path, e))
+        if isinstance(img, pyimglib.decoders.frames_stream.FramesStream):
+            _img = img.next_frame()
+            img.close()
+            img = _img
+    img.draft(None, size)
+    if memory_budget is not None and decoded_size(img) > memory_budget:
+        img.close()
+        raise PreviewTooLarge("{} decodes to {}x{}".format(file_path, img.size[0], img.size[1]))
+    return img
+
+
+def make_preview(
+        file_path: pathlib.Path, output_path: pathlib.Path = None, timings: dict = None, memory_budget: int = None
+):
+    # Runs inside a worker process. With output_path the preview is written straight to that
+    # file and only its size is sent back to the bot process, otherwise the encoded bytes are.
+    # The seconds spent on each step are stored into timings when it is given.
+    if timings is None:
+        timings = dict()
+    start = time.perf_counter()
+    img = open_preview_source(file_path, PREVIEW_SIZE, memory_budget)
+    img.load()
+    timings["decode"] = time.perf_counter() - start
+    start = time.perf_counter()
+    if preview_mode(img) != img.mode:
+        img = img.convert(preview_mode(img))
+    img.thumbnail(PREVIEW_SIZE)
+    timings["thumbnail"] = time.perf_counter() - start
+    start = time.perf_counter()
+    buffer = io.BytesIO()
+    img.save(buffer, "WEBP", quality=90, method=4)
+    timings["encode"] = time.perf_counter() - start
+    if output_path is None:
+        return buffer.getvalue()
+    start = time.perf_counter()
+    with buffer.getbuffer() as encoded:
+        if len(encoded):
+            atomic_write(output_path, encoded)
+        timings["write"] = time.perf_counter() - start
+        return len(encoded)
+
+
+def make_timed_preview(file_path: pathlib.Path, output_path: pathlib.Path = None, memory_budget: int = None):
+    timings = dict()
+    result = make_preview(file_path, output_path, timings, memory_budget)
+    return result, timings
+
+
+def make_animated_preview(file_path: pathlib.Path, max_frames: int, memory_budget: int, timings: dict = None) -> bytes:
+    # Short GIF of the first frames of an animation for send_animation. Frames are decoded one
+    # at a time and only their scaled down copies are kept, up to max_frames or memory_budget
+    # bytes of them. Returns no bytes for a still image.
+    if timings is None:
+        timings = dict()
+    start = time.perf_counter()
+    frames = []
+    durations = []
+    kept_size = 0
+    with open_image(file_path) as img:
+        if getattr(img, "n_frames", 1) < 2:
+            return b""
+        # every frame is converted to RGBA at full size before it is scaled down
+        if img.size[0] * img.size[1] * 4 > memory_budget:
+            raise PreviewTooLarge("{} frames are {}x{}".format(file_path, img.size[0], img.size[1]))
+        for i in range(min(img.n_frames, max_frames)):
+            img.seek(i)
+            frame = img.convert("RGBA")
+            frame.thumbnail(ANIMATED_PREVIEW_SIZE)
+            if len(frames) and kept_size + decoded_size(frame) > memory_budget:
+                break
+            kept_size += decoded_size(frame)
+            frames.append(frame)
+            durations.append(img.info.get("duration", 100))
+    timings["decode"] = time.perf_counter() - start
+    start = time.perf_counter()
+    buffer = io.BytesIO()
+    frames[0].save(
+        buffer, "GIF", save_all=True, append_images=frames[1:], duration=durations, loop=0, disposal=2
+    )
+    timings["encode"] = time.perf_counter() - start
+    return buffer.getvalue()
+
+
+def make_timed_animated_preview(file_path: pathlib.Path, max_frames: int, memory_budget: int):
+    timings = dict()
+    result = make_animated_preview(file_path, max_frames, memory_budget, timings)
+    return result, timings
+
+
+class Transcoder:
+    # Process pool for the CPU bound preview encoding. At most workers + queue_depth previews
+    # may be requested at once, further requests fail with TranscoderBusy instead of piling up.
+    # memory_budget caps the decoded pixels of one preview in bytes, previews of larger images
+    # fail with PreviewTooLarge. Animated previews keep at most animation_max_frames frames.
+    # When a worker dies (e.g. killed for memory) the pool is started again, and the previews
+    # that were running on it fail with TranscoderCrashed.
+    def __init__(
+            self,
+            workers: int,
+            queue_depth: int,
+            memory_budget: int = None,
+            animation_max_frames: int = 50,
+            animation_memory_budget: int = 64 * 1024 ** 2
+    ):
+        self.workers = workers
+        self._executor = self._start_executor()
+        self._slots = asyncio.Semaphore(workers + queue_depth)
+        self.memory_budget = memory_budget
+        self.animation_max_frames = animation_max_frames
+        self.animation_memory_budget = animation_memory_budget
+
+    def _start_executor(self):
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def _restart_executor(self, broken_executor):
+        if self._executor is not broken_executor:
+            # another request already started a new one
+            return
+        logger.error("transcoder worker died, starting a new process pool")
+        self._executor = self._start_executor()
+        broken_executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _run(self, file_path: pathlib.Path, func, *args):
+        if self._slots.locked():
+            raise TranscoderBusy(str(file_path))
+        loop = asyncio.get_running_loop()
+        async with self._slots:
+            executor = self._executor
+            try:
+                result, timings = await loop.run_in_executor(executor, func, file_path, *args)
+            except concurrent.futures.process.BrokenProcessPool:
+                self._restart_executor(executor)
+                raise TranscoderCrashed(str(file_path))
+        for step, seconds in timings.items():
+            metrics.observe_stage(step, seconds)
+        return result
+
+    async def make_preview(self, file_path: pathlib.Path, output_path: pathlib.Path = None):
+        return await self._run(file_path, make_timed_preview, output_path, self.memory_budget)
+
+    async def make_animated_preview(self, file_path: pathlib.Path) -> bytes:
+        return await self._run(
+            file_path, make_timed_animated_preview, self.animation_max_frames, self.animation_memory_budget
+        )
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,73 @@
+import asyncio
+import contextlib
+import io
+import logging
+import pathlib
+import resource
+
+import telegram
+
+logger = logging.getLogger(__name__)
+
+
+class StreamedInputFile(telegram.InputFile):
+    # python-telegram-bot reads a file handle into memory when the InputFile is created (up to
+    # 21.5, which added read_file_handle, always). This one hands the open file to the HTTP
+    # client instead, which reads it in chunks while the request is sent.
+    def __init__(self, file_handle, filename: str, attach: bool = False):
+        super().__init__(b"", filename=filename, attach=attach)
+        self._file_handle = file_handle
+
+    @property
+    def field_tuple(self):
+        # rewound for every request, so a send retried after a flood wait uploads the whole file
+        self._file_handle.seek(0)
+        return self.filename, self._file_handle, self.mimetype
+
+
+def peak_rss_kib() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Uploader:
+    # Bounds the number of concurrent file uploads and streams files from disk instead of
+    # loading them into memory, so peak memory does not grow with the size of the originals.
+    def __init__(self, max_concurrent_uploads: int):
+        self._slots = asyncio.Semaphore(max_concurrent_uploads)
+        self.peak_rss_kib = peak_rss_kib()
+
+    @staticmethod
+    async def _input_file(file, stack: contextlib.ExitStack, attach=False):
+        # paths and open files are streamed, file ids and bytes are passed on as they are
+        if isinstance(file, pathlib.Path):
+            file = await asyncio.to_thread(file.open, "rb")
+        if isinstance(file, io.BufferedReader):
+            stack.enter_context(file)
+            return StreamedInputFile(file, filename=pathlib.Path(file.name).name, attach=attach)
+        return file
+
+    def _check_peak_rss(self, file):
+        current_peak = peak_rss_kib()
+        if current_peak > self.peak_rss_kib:
+            if isinstance(file, io.BufferedReader):
+                file = file.name
+            elif not isinstance(file, (pathlib.Path, str)):
+                file = "{} of {} bytes".format(type(file).__name__, len(file))
+            logger.info("peak RSS grew to {} KiB after upload of {}".format(current_peak, file))
+            self.peak_rss_kib = current_peak
+
+    @contextlib.asynccontextmanager
+    async def open(self, file):
+        async with self._slots:
+            with contextlib.ExitStack() as stack:
+                yield await self._input_file(file, stack)
+            self._check_peak_rss(file)
+
+    @contextlib.asynccontextmanager
+    async def open_group(self, files):
+        # The files of a media group are sent in one request, so they take one upload slot.
+        async with self._slots:
+            with contextlib.ExitStack() as stack:
+                yield [await self._input_file(file, stack, attach=True) for file in files]
+            for file in files:
+                self._check_peak_rss(file)